@@ -0,0 +1,432 @@
+#!/usr/bin/python3 -u
+# -*- coding: utf-8 -*-
+"""
+Vectorized backtest of the pricing parameters of terra_oracle_vote.py
+
+Replays the voter's LUNA pricing over a price archive (PRICE_ARCHIVE_FILE)
+and scores every would-be vote against the on-chain exchange rate the
+round was tallied into, i.e. the swap rate read at the next round. Rounds
+are replayed in NumPy batches (rounds x venues), not one at a time, so
+months of history take seconds and parameter grids can be swept on a
+process pool.
+
+    python3 oracle_backtest.py prices.bin
+    python3 oracle_backtest.py prices.bin --set AGGREGATION_METHOD=trimmed_mean --start 2021-03-01
+    python3 oracle_backtest.py prices.bin --workers 8 \\
+        --sweep STOP_ORACLE_EXCHANGE_DIVERGENCE=0.02,0.05,0.1 \\
+        --sweep VWMA_PERIOD=0,600,1800 --sweep BITHUMB_SHARE_DEFAULT=0,0.5,1
+
+Parameters are named like the voter settings and default to the current
+environment: STOP_ORACLE_EXCHANGE_DIVERGENCE, STOP_ORACLE_RECENT_DIVERGENCE,
+BID_ASK_SPREAD_MAX, VWMA_PERIOD, AGGREGATION_METHOD, TRIM_FRACTION and
+<VENUE>_SHARE_DEFAULT for each LUNA/KRW venue.
+
+The archive must come from a voter recording the order books
+("<venue>-ask", "<venue>-bid") and trades ("<venue>-trades",
+"<venue>-volume"); a venue only has trades archived while it was priced by
+VWAP, and only a book otherwise, so a VWMA_PERIOD different from the one
+recorded leaves such venues without a quote. A vote outside the reward
+band or an abstention (all sources failed, or STOP_ORACLE_RECENT_DIVERGENCE
+tripped) is counted as a miss; the on-chain standard deviation, which can
+widen the band, is not recorded and not modeled.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import itertools
+import json
+import sys
+import warnings
+
+import numpy as np
+
+import terra_oracle_vote as voter
+
+# rounds replayed per batch; bounds the (rounds x venues) intermediates
+BATCH_ROUNDS = 65536
+# BandDataSource.luna_prices quotes every venue in this currency
+BAND_BASE_CURRENCY = "ukrw"
+
+
+def parse_time(text):
+    """A unix timestamp or an ISO date (UTC)."""
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def krw_venues():
+    """The venues of the LUNA aggregate, in the base currency of the reference exchange."""
+    base_currency = voter.exchange_adapters[voter.reference_exchange].base_currency
+    return [name for name, adapter in voter.exchange_adapters.items() if adapter.base_currency == base_currency]
+
+
+def default_parameters():
+    parameters = {
+        "STOP_ORACLE_EXCHANGE_DIVERGENCE": voter.stop_oracle_trigger_exchange_diverge,
+        "STOP_ORACLE_RECENT_DIVERGENCE": voter.stop_oracle_trigger_recent_diverge,
+        "BID_ASK_SPREAD_MAX": voter.bid_ask_spread_max,
+        "VWMA_PERIOD": voter.vwma_period,
+        "AGGREGATION_METHOD": voter.aggregation_method,
+        "TRIM_FRACTION": voter.trim_fraction,
+    }
+    for name in krw_venues():
+        parameters[name.upper() + "_SHARE_DEFAULT"] = voter.exchange_adapters[name].weight
+    return parameters
+
+
+def parse_value(key, text):
+    if key == "AGGREGATION_METHOD":
+        if text not in ("weighted_median", "trimmed_mean"):
+            raise ValueError("unknown AGGREGATION_METHOD " + text)
+        return text
+    if key == "VWMA_PERIOD":
+        return int(text)
+    return float(text)
+
+
+class Dataset:
+    """The archive grouped by series, replayed on the rounds of one chain.
+
+    The rounds are the samples of the chain's swap rate of the reference
+    base currency (one per round the voter ran); every other series is read
+    as of each round with searchsorted.
+    """
+
+    def __init__(self, path, chain_id, start=None, end=None):
+        names, records = voter.load_price_archive(path)
+        series_ids = np.asarray(records["series"])
+        order = np.argsort(series_ids, kind="stable")
+        bounds = np.searchsorted(series_ids[order], np.arange(len(names) + 1))
+        timestamps, values = np.asarray(records["timestamp"]), np.asarray(records["value"])
+        self.series = {}
+        for series_id, name in enumerate(names):
+            rows = order[bounds[series_id]:bounds[series_id + 1]]
+            by_time = np.argsort(timestamps[rows], kind="stable")
+            self.series[name] = (timestamps[rows][by_time], values[rows][by_time])
+
+        self.chain_id = chain_id
+        self.base_currency = voter.exchange_adapters[voter.reference_exchange].base_currency
+        rounds = self.get("swap:" + chain_id, self.base_currency)[0]
+        keep = np.ones(len(rounds), dtype=bool)
+        if start is not None:
+            keep &= rounds >= start
+        if end is not None:
+            keep &= rounds < end
+        self.rounds = rounds[keep]
+        # the next swap rate further than this is after a gap in the voter's rounds, not the tally
+        self.tally_max_age = 2.0 * np.median(np.diff(rounds)) if len(rounds) > 1 else np.inf
+        if voter.hardfix_active_set:
+            active = voter.hardfix_active_set
+        else:
+            active = [name.partition("/")[2] for name in self.series if name.startswith("swap:" + chain_id + "/")]
+        self.denoms = [denom for denom in active if denom not in voter.abstain_set]
+        self.vwap_cache = {}
+
+    def get(self, source, denom):
+        return self.series.get(source + "/" + denom, (np.zeros(0), np.zeros(0)))
+
+    def as_of(self, source, denom, times, max_age, after=False):
+        """The latest sample at or before each time, NaN when missing or older than max_age.
+
+        With after=True, the first sample strictly after each time instead.
+        """
+        ts, values = self.get(source, denom)
+        out = np.full(len(times), np.nan)
+        if len(ts) == 0:
+            return out
+        if after:
+            i = np.searchsorted(ts, times, side="right")
+            ok = i < len(ts)
+            out[ok] = values[i[ok]]
+            out[ok & (ts[np.minimum(i, len(ts) - 1)] - times > max_age)] = np.nan
+            return out
+        i = np.searchsorted(ts, times, side="right") - 1
+        ok = i >= 0
+        out[ok] = values[i[ok]]
+        out[ok & (times - ts[np.maximum(i, 0)] > max_age)] = np.nan
+        return out
+
+    def quote(self, source, denom, times, lag):
+        """The quote fetched for each round: recorded up to MARKET_MAX_AGE before it or lag seconds after."""
+        return self.as_of(source, denom, times + lag, lag + voter.market_max_age)
+
+    def vwap(self, exchange, times, period):
+        """The VWAP over (time - period, time] of the archived trades, NaN without trades."""
+        if exchange not in self.vwap_cache:
+            ts, price = self.get(exchange + "-trades", self.base_currency)
+            volume = self.get(exchange + "-volume", self.base_currency)[1]
+            if len(volume) != len(price):
+                raise ValueError("{} trades and volumes are not paired".format(exchange))
+            self.vwap_cache[exchange] = (ts, np.concatenate(([0.0], np.cumsum(price * volume))),
+                                    np.concatenate(([0.0], np.cumsum(volume))))
+        ts, cum_price_volume, cum_volume = self.vwap_cache[exchange]
+        hi = np.searchsorted(ts, times, side="right")
+        lo = np.searchsorted(ts, times - period, side="right")
+        volume = cum_volume[hi] - cum_volume[lo]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(volume > 0, (cum_price_volume[hi] - cum_price_volume[lo]) / volume, np.nan)
+
+
+def weighted_median_rows(values, weights, average_split=True):
+    """weighted_median of every row; weight 0 leaves a value out, rows without weight are NaN."""
+    order = np.argsort(np.where(weights > 0, values, np.inf), axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+    cumulative = np.cumsum(weights, axis=1)
+    half = cumulative[:, -1:] / 2.0
+    # first index reaching half the weight, as np.searchsorted does
+    i = np.argmax(cumulative >= half, axis=1)
+    rows = np.arange(len(values))
+    count = (weights > 0).sum(axis=1)
+    nxt = np.minimum(i + 1, values.shape[1] - 1)
+    split = average_split & np.isclose(cumulative[rows, i], half[:, 0]) & (i + 1 < count)
+    price = np.where(split, (values[rows, i] + values[rows, nxt]) / 2.0, values[rows, i])
+    return np.where(count > 0, price, np.nan)
+
+
+def weighted_trimmed_mean_rows(values, weights, fraction):
+    """weighted_trimmed_mean of every row, with weighted_median_rows for its fallback."""
+    order = np.argsort(np.where(weights > 0, values, np.inf), axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+    values = np.where(weights > 0, values, 0.0)
+    cumulative = np.cumsum(weights, axis=1)
+    low, high = cumulative[:, -1:] * fraction, cumulative[:, -1:] * (1.0 - fraction)
+    kept = np.clip(cumulative, low, high) - np.clip(cumulative - weights, low, high)
+    total = kept.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        price = (values * kept).sum(axis=1) / total
+    return np.where(total > 0, price, weighted_median_rows(values, weights))
+
+
+def luna_quotes(dataset, times, parameters, quote_lag, fx):
+    """(ask, bid, mid) of each KRW venue, rounds x venues, with the Band fallback of prepare_votes."""
+    venues = krw_venues()
+    ask, bid, mid = (np.full((len(times), len(venues)), np.nan) for _ in range(3))
+    for j, name in enumerate(venues):
+        if parameters["VWMA_PERIOD"] > 1 and name in voter.trade_feeds:
+            ask[:, j] = bid[:, j] = mid[:, j] = dataset.vwap(name, times, parameters["VWMA_PERIOD"])
+        else:
+            ask[:, j] = dataset.quote(name + "-ask", dataset.base_currency, times, quote_lag)
+            bid[:, j] = dataset.quote(name + "-bid", dataset.base_currency, times, quote_lag)
+            mid[:, j] = (ask[:, j] + bid[:, j]) / 2.0
+        missing = np.isnan(mid[:, j])
+        band = band_quote(dataset, name, dataset.base_currency, times, quote_lag, fx)
+        ask[missing, j] = bid[missing, j] = mid[missing, j] = band[missing]
+    return ask, bid, mid
+
+
+def band_quote(dataset, name, base_currency, times, quote_lag, fx):
+    """Band's LUNA price of a venue in base_currency, converted from BAND_BASE_CURRENCY like convert_quote."""
+    price = dataset.quote("band-" + name, BAND_BASE_CURRENCY, times, quote_lag)
+    if base_currency == BAND_BASE_CURRENCY:
+        return price
+    return price * fx[voter.fx_map[base_currency]] / fx[voter.fx_map[BAND_BASE_CURRENCY]]
+
+
+def combined_fx(dataset, times):
+    """combine_fx as of each round: the median over providers with a fresh rate, per symbol."""
+    max_age = voter.parse_provider_seconds(voter.fx_max_age)
+    fx = {}
+    for symbol in sorted(set(voter.fx_map.values())):
+        rates = np.stack([dataset.as_of("fx-" + provider, symbol, times, max_age.get(provider, 1800))
+                          for provider in voter.fx_api_collection])
+        with warnings.catch_warnings():
+            # rounds without any fresh provider are NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            fx[symbol] = np.nanmedian(rates, axis=0)
+    return fx
+
+
+def replay_batch(dataset, times, parameters, quote_lag):
+    """Replays prepare_votes for a batch of rounds; returns per-round deviations and drop counts."""
+    fx = combined_fx(dataset, times)
+    fx_error = np.zeros(len(times), dtype=bool)
+    for rates in fx.values():
+        fx_error |= np.isnan(rates)
+
+    venues = krw_venues()
+    ask, bid, mid = luna_quotes(dataset, times, parameters, quote_lag, fx)
+    weight = np.array([parameters[name.upper() + "_SHARE_DEFAULT"] for name in venues], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        present = ~np.isnan(mid) & (weight > 0)
+        wide = present & ~(ask / bid - 1.0 <= parameters["BID_ASK_SPREAD_MAX"])
+        keep = present & ~wide
+        consensus = weighted_median_rows(mid, np.where(keep, weight, 0.0), average_split=False)
+        diverged = keep & ~(np.abs(mid / consensus[:, None] - 1.0) <= parameters["STOP_ORACLE_EXCHANGE_DIVERGENCE"])
+    keep &= ~diverged
+    if parameters["AGGREGATION_METHOD"] == "trimmed_mean":
+        luna_krw = weighted_trimmed_mean_rows(mid, np.where(keep, weight, 0.0), parameters["TRIM_FRACTION"])
+    else:
+        luna_krw = weighted_median_rows(mid, np.where(keep, weight, 0.0))
+
+    usd = voter.exchange_adapters[voter.usd_reference_exchange]
+    luna_usd = dataset.quote(usd.name, usd.base_currency, times, quote_lag)
+    luna_usd = np.where(np.isnan(luna_usd), band_quote(dataset, usd.name, usd.base_currency, times, quote_lag, fx),
+                        luna_usd)
+    error = fx_error | np.isnan(luna_krw) | np.isnan(luna_usd)
+
+    luna_base = voter.fx_map[dataset.base_currency]
+    result = {"rounds": len(times), "error": int(error.sum()), "denoms": {},
+              "dropped": {name: {"no_quote": int(np.isnan(mid[:, j]).sum()) if weight[j] > 0 else 0,
+                                 "wide_spread": int(wide[:, j].sum()), "diverged": int(diverged[:, j].sum())}
+                          for j, name in enumerate(venues)}}
+    for denom in dataset.denoms:
+        rate = fx.get(voter.fx_map.get(denom), np.full(len(times), np.nan))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if voter.fx_map.get(denom) == luna_base:
+                market = (luna_krw + luna_usd * fx[luna_base]) / 2.0 * rate / fx[luna_base]
+            else:
+                market = luna_usd * rate
+            swap = dataset.as_of("swap:" + dataset.chain_id, denom, times, np.inf)
+            swap = np.where(np.isnan(swap), 0.00000001, swap)
+            recent_diverged = ~(np.abs(market / swap - 1.0) <= parameters["STOP_ORACLE_RECENT_DIVERGENCE"])
+            vote = np.where(error | np.isnan(market) | recent_diverged, 0.0, market)
+            # the rate this round was tallied into is read at the next round
+            tallied = dataset.as_of("swap:" + dataset.chain_id, denom, times, dataset.tally_max_age, after=True)
+            deviation = vote / tallied - 1.0
+        scored = ~np.isnan(tallied)
+        result["denoms"][denom] = (deviation[scored], vote[scored] == 0.0)
+    return result
+
+
+def summarize(parts, reward_band):
+    """Merges the batches of one run into miss rates and |deviation| percentiles per denom."""
+    summary = {"rounds": sum(part["rounds"] for part in parts), "error": sum(part["error"] for part in parts),
+               "dropped": {}, "denoms": {}}
+    for part in parts:
+        for name, reasons in part["dropped"].items():
+            for reason, count in reasons.items():
+                summary["dropped"].setdefault(name, {}).setdefault(reason, 0)
+                summary["dropped"][name][reason] += count
+
+    all_deviations, all_abstain = [], []
+    for denom in parts[0]["denoms"] if parts else []:
+        deviation = np.concatenate([part["denoms"][denom][0] for part in parts])
+        abstain = np.concatenate([part["denoms"][denom][1] for part in parts])
+        all_deviations.append(deviation)
+        all_abstain.append(abstain)
+        summary["denoms"][denom] = score(deviation, abstain, reward_band)
+    if all_deviations:
+        summary["all"] = score(np.concatenate(all_deviations), np.concatenate(all_abstain), reward_band)
+    return summary
+
+
+def score(deviation, abstain, reward_band):
+    voted = np.abs(deviation[~abstain])
+    outside = int((voted > reward_band / 2.0).sum())
+    stats = {"votes": len(deviation), "abstain": int(abstain.sum()), "outside_band": outside,
+             "miss_rate": (outside + int(abstain.sum())) / len(deviation) if len(deviation) else None}
+    if len(voted):
+        stats["mean"] = float(voted.mean())
+        stats.update({key: float(value) for key, value in
+                      zip(("p50", "p90", "p99"), np.percentile(voted, [50, 90, 99]))})
+        stats["max"] = float(voted.max())
+    return stats
+
+
+def backtest(dataset, parameters, quote_lag, reward_band, batch_rounds=BATCH_ROUNDS):
+    parts = [replay_batch(dataset, dataset.rounds[i:i + batch_rounds], parameters, quote_lag)
+             for i in range(0, len(dataset.rounds), batch_rounds)]
+    return summarize(parts, reward_band)
+
+
+# the dataset of a pool worker, loaded once by its initializer
+worker_dataset = None
+
+
+def load_worker(path, chain_id, start, end):
+    global worker_dataset
+    if worker_dataset is None:
+        worker_dataset = Dataset(path, chain_id, start, end)
+
+
+def run_worker(parameters, quote_lag, reward_band):
+    return parameters, backtest(worker_dataset, parameters, quote_lag, reward_band)
+
+
+def print_results(results, base):
+    swept = [key for key in base if any(parameters[key] != base[key] for parameters, _ in results)]
+    print("{:>8}{:>9}{:>9}{:>9}{:>9}{:>9}  {}".format(
+        "rounds", "miss %", "abst %", "p50 %", "p90 %", "p99 %", "parameters"))
+    for parameters, summary in sorted(results, key=lambda result: result[1].get("all", {}).get("miss_rate") or 0):
+        overall = summary.get("all", {})
+        label = ",".join("{}={}".format(key, parameters[key]) for key in swept) or "current settings"
+        print("{:>8}{:>9.2f}{:>9.2f}{:>9.3f}{:>9.3f}{:>9.3f}  {}".format(
+            summary["rounds"], (overall.get("miss_rate") or 0) * 100,
+            overall.get("abstain", 0) * 100.0 / max(overall.get("votes", 0), 1),
+            overall.get("p50", float("nan")) * 100, overall.get("p90", float("nan")) * 100,
+            overall.get("p99", float("nan")) * 100, label))
+    if len(results) == 1:
+        summary = results[0][1]
+        print("{:<10}{:>9}{:>9}{:>9}{:>10}{:>10}{:>10}".format(
+            "denom", "votes", "outside", "abstain", "p50 %", "p90 %", "p99 %"))
+        for denom, stats in summary["denoms"].items():
+            print("{:<10}{:>9}{:>9}{:>9}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+                denom, stats["votes"], stats["outside_band"], stats["abstain"], stats.get("p50", float("nan")) * 100,
+                stats.get("p90", float("nan")) * 100, stats.get("p99", float("nan")) * 100))
+        print("dropped: " + ", ".join("{}({})".format(name, ", ".join(
+            "{}={}".format(reason, count) for reason, count in reasons.items() if count))
+            for name, reasons in summary["dropped"].items() if any(reasons.values())))
+
+
+def main():
+    global worker_dataset
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive", nargs="?", default=voter.price_archive_file, help="price archive (PRICE_ARCHIVE_FILE)")
+    parser.add_argument("--chain-id", default=voter.chain_id)
+    parser.add_argument("--start", type=parse_time, help="first round, unix time or ISO date (UTC)")
+    parser.add_argument("--end", type=parse_time, help="end of the rounds, unix time or ISO date (UTC)")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="override a parameter")
+    parser.add_argument("--sweep", action="append", default=[], metavar="KEY=V1,V2,...",
+                        help="try every value; several --sweep run their cartesian product")
+    parser.add_argument("--reward-band", type=float, default=0.02,
+                        help="oracle reward band; votes further than half of it from the tallied rate miss")
+    parser.add_argument("--quote-lag", type=float, default=10,
+                        help="seconds after a round's swap rate its exchange and Band quotes may be archived")
+    parser.add_argument("--workers", type=int, default=1, help="processes for a sweep")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+    if not args.archive:
+        parser.error("no archive given and PRICE_ARCHIVE_FILE is not set")
+
+    base = default_parameters()
+    for item in args.set:
+        key, _, value = item.partition("=")
+        if key not in base:
+            parser.error("unknown parameter " + key)
+        base[key] = parse_value(key, value)
+    grid = []
+    for item in args.sweep:
+        key, _, values = item.partition("=")
+        if key not in base:
+            parser.error("unknown parameter " + key)
+        grid.append([(key, parse_value(key, value)) for value in values.split(",")])
+    runs = [dict(base, **dict(combination)) for combination in itertools.product(*grid)]
+
+    dataset = Dataset(args.archive, args.chain_id, args.start, args.end)
+    if len(dataset.rounds) == 0:
+        sys.exit("no swap:{}/{} rounds in {}".format(args.chain_id, dataset.base_currency, args.archive))
+    if args.workers > 1 and len(runs) > 1:
+        # forked workers inherit the loaded dataset; others load it in load_worker
+        worker_dataset = dataset
+        with concurrent.futures.ProcessPoolExecutor(
+                args.workers, initializer=load_worker,
+                initargs=(args.archive, args.chain_id, args.start, args.end)) as pool:
+            results = list(pool.map(run_worker, runs, itertools.repeat(args.quote_lag),
+                                    itertools.repeat(args.reward_band)))
+    else:
+        results = [(parameters, backtest(dataset, parameters, args.quote_lag, args.reward_band))
+                   for parameters in runs]
+
+    if args.json:
+        print(json.dumps([{"parameters": parameters, "summary": summary} for parameters, summary in results], indent=1))
+    else:
+        print_results(results, base)
+
+
+if __name__ == "__main__":
+    main()
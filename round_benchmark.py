@@ -0,0 +1,422 @@
+#!/usr/bin/python3 -u
+# -*- coding: utf-8 -*-
+"""
+Offline replay benchmark for terra_oracle_vote.py
+
+Runs the voter against a local stand-in server that plays the LCD, the
+Tendermint RPC (NewBlock websocket and broadcast_tx_sync), the exchanges,
+the FX APIs and BandChain from recorded responses, with a fake terracli.
+Reports per-stage and end-to-end latency percentiles and throughput over
+many rounds, so regressions show up before deploying.
+
+    python3 round_benchmark.py --rounds 20 --block-time 0.5
+    python3 round_benchmark.py --env PIPELINE_LEAD_BLOCKS=0 --json
+    python3 round_benchmark.py --serve --block-time 6 --port 26680
+
+--serve only runs the stand-in, e.g. as the MOCK_LCD of a DRY_RUN voter
+fetching live exchange prices.
+
+Fixtures (round_benchmark_fixtures.json) list responses by method, path
+(host/path as rewritten through HTTP_REPLAY_URL) and a query subset, with
+an optional delay that simulates the remote's latency. Strings like
+"{now-30}" and "{kst-30}" are replaced with a unix timestamp or a KST date
+30 seconds before the request, so trade windows stay populated.
+With --record, requests without a fixture are fetched from the real host
+and added to the fixture file.
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import hashlib
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+VOTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "terra_oracle_vote.py")
+
+FAKE_TERRACLI = '''#!{python}
+# fake terracli for round_benchmark.py: signs with a dummy signature and
+# reports broadcasts to the replay server
+import json, os, sys, urllib.request
+
+args = sys.argv[1:]
+tx = json.load(open(args[2]))
+if args[:2] == ["tx", "sign"]:
+    tx["value"]["signatures"] = [{{
+        "pub_key": {{"type": "tendermint/PubKeySecp256k1", "value": "A" * 44}},
+        "signature": "A" * 88
+    }}]
+    print(json.dumps(tx))
+elif args[:2] == ["tx", "broadcast"]:
+    request = urllib.request.Request(
+        os.environ["BENCH_REPLAY_URL"] + "/_broadcast",
+        data=json.dumps(tx).encode(),
+        headers={{"Content-Type": "application/json"}})
+    print(urllib.request.urlopen(request).read().decode())
+'''
+
+KST = datetime.timezone(datetime.timedelta(hours=9))
+RELATIVE_TIME = re.compile(r"^\{(now|kst)-(\d+)\}$")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def relative_times(body, now):
+    """Replaces "{now-N}" / "{kst-N}" placeholders in a fixture body."""
+    if isinstance(body, dict):
+        return {key: relative_times(value, now) for key, value in body.items()}
+    if isinstance(body, list):
+        return [relative_times(value, now) for value in body]
+    if isinstance(body, str):
+        match = RELATIVE_TIME.match(body)
+        if match:
+            timestamp = int(now) - int(match.group(2))
+            if match.group(1) == "now":
+                return str(timestamp)
+            return datetime.datetime.fromtimestamp(timestamp, KST).strftime("%Y-%m-%d %H:%M:%S")
+    return body
+
+
+class ReplayServer:
+    """Stand-in for every remote the voter talks to, producing a block every block_time seconds."""
+
+    def __init__(self, fixtures, block_time, start_height=2500000, record=False, port=None):
+        self.fixtures = fixtures
+        self.block_time = block_time
+        self.height = start_height
+        self.record = record
+        self.recorded = []
+        self.prevotes = []
+        self.broadcasts = []
+        self.pending_txs = []
+        # txhash -> height of the block that included it
+        self.included = {}
+        self.websockets = set()
+        self.port = port or free_port()
+        self.url = "http://127.0.0.1:{}".format(self.port)
+
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self._serve, args=(ready,), daemon=True).start()
+        ready.wait()
+        return self
+
+    def _serve(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_get("/websocket", self.handle_websocket)
+        app.router.add_get("/stream.binance.com:9443/ws/{stream}", self.handle_book_ticker)
+        app.router.add_post("/", self.handle_jsonrpc)
+        app.router.add_post("/_broadcast", self.handle_broadcast)
+        app.router.add_get("/lcd/blocks/latest", self.handle_latest_block)
+        app.router.add_get("/lcd/oracle/voters/{validator}/prevotes", self.handle_prevotes)
+        app.router.add_get("/lcd/oracle/voters/{validator}/miss", self.handle_miss)
+        app.router.add_post("/lcd/txs/estimate_fee", self.handle_estimate_fee)
+        app.router.add_get("/lcd/txs/{txhash}", self.handle_tx)
+        app.router.add_route("*", "/{path:.*}", self.handle_fixture)
+        runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        self.loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", self.port).start())
+        self.loop.create_task(self.produce_blocks())
+        ready.set()
+        self.loop.run_forever()
+
+    def block_header(self):
+        return {
+            "height": str(self.height),
+            "time": datetime.datetime.utcnow().isoformat() + "Z"
+        }
+
+    async def produce_blocks(self):
+        while True:
+            await asyncio.sleep(self.block_time)
+            self.height += 1
+            event = {"jsonrpc": "2.0", "id": "0#event", "result": {
+                "query": "tm.event='NewBlock'",
+                "data": {"type": "tendermint/event/NewBlock", "value": {"block": {"header": self.block_header()}}}
+            }}
+            # txs broadcast during the last block are included in this one
+            events = [event] + [{"jsonrpc": "2.0", "id": "1#event", "result": {
+                "query": "tm.event='Tx'",
+                "data": {"type": "tendermint/event/Tx", "value": {"TxResult": {
+                    "height": str(self.height), "index": 0, "tx": tx, "result": {"code": 0}}}}
+            }} for txhash, tx in self.pending_txs]
+            for txhash, tx in self.pending_txs:
+                self.included[txhash] = self.height
+            self.pending_txs = []
+            for ws in list(self.websockets):
+                try:
+                    for message in events:
+                        await ws.send_json(message)
+                except ConnectionError:
+                    self.websockets.discard(ws)
+
+    async def handle_websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.websockets.add(ws)
+        async for msg in ws:
+            subscribe = json.loads(msg.data)
+            await ws.send_json({"jsonrpc": "2.0", "id": subscribe.get("id", 0), "result": {}})
+        self.websockets.discard(ws)
+        return ws
+
+    async def handle_book_ticker(self, request):
+        """Fake Binance bookTicker stream around the recorded book (for STREAM_BOOKS=binance)."""
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        book = self.find_fixture("GET", "api.binance.com/api/v3/ticker/bookTicker", {"symbol": "LUNAUSDT"})["body"]
+        price = (float(book["askPrice"]) + float(book["bidPrice"])) / 2
+        update_id = 0
+        while not ws.closed:
+            update_id += 1
+            await ws.send_json({"u": update_id, "s": "LUNAUSDT", "b": "%.4f" % (price * 0.9995), "B": "100.0",
+                                "a": "%.4f" % (price * 1.0005), "A": "100.0"})
+            await asyncio.sleep(0.1)
+        return ws
+
+    def include_tx(self, tx_base64):
+        self.broadcasts.append((time.time(), self.height))
+        txhash = hashlib.sha256(base64.b64decode(tx_base64)).hexdigest().upper()
+        self.pending_txs.append((txhash, tx_base64))
+        return txhash
+
+    def record_broadcast(self, tx):
+        # terracli mode: the json tx stands in for the amino bytes
+        txhash = self.include_tx(base64.b64encode(json.dumps(tx).encode()).decode())
+        prevotes = [
+            {"hash": msg["value"]["hash"], "denom": msg["value"]["denom"], "voter": msg["value"]["validator"],
+             "submit_block": str(self.height)}
+            for msg in tx["value"]["msg"] if msg["type"] == "oracle/MsgExchangeRatePrevote"]
+        if prevotes:
+            self.prevotes = prevotes
+        return {"height": "0", "txhash": txhash, "code": 0, "raw_log": "[]"}
+
+    async def handle_broadcast(self, request):
+        return web.json_response(self.record_broadcast(await request.json()))
+
+    async def handle_jsonrpc(self, request):
+        # native mode: the amino tx is not decoded, so no prevote is learned
+        body = await request.json()
+        txhash = self.include_tx(body["params"]["tx"])
+        return web.json_response({"jsonrpc": "2.0", "id": body.get("id"), "result": {
+            "code": 0, "data": "", "log": "[]", "hash": txhash}})
+
+    async def handle_estimate_fee(self, request):
+        # a rough oracle gas model: a base cost plus a fixed cost per message
+        body = await request.json()
+        gas = int((50000 + 10000 * len(body["tx"]["msg"])) * float(body["gas_adjustment"]))
+        fees = [{"denom": price["denom"], "amount": str(int(gas * float(price["amount"])))} for price in body["gas_prices"]]
+        return web.json_response({"height": str(self.height), "result": {"fees": fees, "gas": str(gas)}})
+
+    async def handle_tx(self, request):
+        txhash = request.match_info["txhash"].upper()
+        if txhash not in self.included:
+            return web.json_response({"error": "Tx: Response error: RPC error -32603 - Internal error: "
+                                               "tx ({}) not found".format(txhash)}, status=404)
+        return web.json_response({"height": str(self.included[txhash]), "txhash": txhash, "code": 0, "raw_log": "[]"})
+
+    async def handle_latest_block(self, request):
+        return web.json_response({"block": {"header": self.block_header()}})
+
+    async def handle_prevotes(self, request):
+        return web.json_response({"height": str(self.height), "result": self.prevotes})
+
+    async def handle_miss(self, request):
+        return web.json_response({"height": str(self.height), "result": "0"})
+
+    def find_fixture(self, method, path, query):
+        for fixture in self.fixtures["responses"]:
+            if fixture["method"] != method or fixture["path"].rstrip("/") != path.rstrip("/"):
+                continue
+            if all(query.get(key) == value for key, value in fixture.get("query", {}).items()):
+                return fixture
+        return None
+
+    async def handle_fixture(self, request):
+        path = request.match_info["path"]
+        query = dict(request.query)
+        fixture = self.find_fixture(request.method, path, query)
+        if fixture is None and self.record and not path.startswith("lcd/"):
+            fixture = await self.fetch_upstream(request, path, query)
+        if fixture is None:
+            print("no fixture for {} {} {}".format(request.method, path, query), file=sys.stderr)
+            return web.json_response({"error": "no fixture"}, status=404)
+        await asyncio.sleep(fixture.get("delay", 0))
+        return web.json_response(relative_times(fixture["body"], time.time()), status=fixture.get("status", 200))
+
+    async def fetch_upstream(self, request, path, query):
+        started = time.time()
+        async with aiohttp.ClientSession() as session:
+            async with session.request(request.method, "https://" + path, params=query,
+                                       data=await request.read(), headers={"Content-Type": "application/json"}) as response:
+                body = await response.json(content_type=None)
+        query.pop("apikey", None)
+        fixture = {"method": request.method, "path": path, "query": query,
+                   "delay": round(time.time() - started, 3), "body": body}
+        self.fixtures["responses"].append(fixture)
+        self.recorded.append(fixture)
+        return fixture
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return float("nan")
+    rank = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(traces, wall_time, boundaries):
+    stages = {}
+    for trace in traces:
+        for stage, seconds in trace["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+        stages.setdefault("end_to_end", []).append(trace["end_to_end"])
+    summary = {"rounds": len(traces), "boundaries": boundaries, "wall_time": wall_time,
+               "rounds_per_minute": 60.0 * len(traces) / wall_time if wall_time else 0.0,
+               "outcomes": {}, "stages": {}}
+    for trace in traces:
+        summary["outcomes"][trace["outcome"]] = summary["outcomes"].get(trace["outcome"], 0) + 1
+    for stage, values in stages.items():
+        values.sort()
+        summary["stages"][stage] = {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": values[-1]
+        }
+    return summary
+
+
+def print_summary(summary):
+    print("{rounds} rounds over {boundaries} round boundaries in {wall_time:.1f}s "
+          "({rounds_per_minute:.1f} rounds/min)".format(**summary))
+    print("outcomes: " + ", ".join("{}={}".format(k, v) for k, v in sorted(summary["outcomes"].items())))
+    print("{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}".format("stage (ms)", "count", "p50", "p90", "p99", "max"))
+    for stage, stats in summary["stages"].items():
+        print("{:<16}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            stage, stats["count"], stats["p50"] * 1000, stats["p90"] * 1000, stats["p99"] * 1000, stats["max"] * 1000))
+
+
+def run_benchmark(args):
+    fixtures = json.load(open(args.fixtures))
+    server = ReplayServer(fixtures, args.block_time, record=bool(args.record)).start()
+    workdir = tempfile.mkdtemp(prefix="oracle-bench-")
+    terracli = os.path.join(workdir, "terracli")
+    with open(terracli, "w") as fake:
+        fake.write(FAKE_TERRACLI.format(python=sys.executable))
+    os.chmod(terracli, 0o755)
+    timing_log = os.path.join(workdir, "rounds.jsonl")
+
+    env = dict(os.environ)
+    env.update({
+        "TERRA_LCD": server.url + "/lcd",
+        "NODE_RPC": "tcp://127.0.0.1:{}".format(server.port),
+        "HTTP_REPLAY_URL": server.url,
+        "BENCH_REPLAY_URL": server.url,
+        "BAND_ENDPOINT": server.url + "/terra-lcd.bandchain.org",
+        "TERRACLI_BIN": terracli,
+        "KEY_NAME": "bench",
+        "KEY_PASSWORD": "bench",
+        "HOME_CLI": workdir,
+        "FEEDER_ADDRESS": fixtures["feeder"],
+        "VALIDATOR_ADDRESS": fixtures["validator"],
+        "ALPHAVANTAGE_KEY": "bench",
+        "METRICS_PORT": str(free_port()),
+        "ROUND_TIMING_LOG": timing_log,
+        "TELEGRAM_TOKEN": "",
+        "SLACK_URL": "",
+        "DEBUG": "false",
+    })
+    for setting in args.env:
+        key, _, value = setting.partition("=")
+        env[key] = value
+
+    log = open(os.path.join(workdir, "voter.log"), "w")
+    voter = subprocess.Popen([sys.executable, "-u", VOTER], env=env, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    start_height = server.height
+    started = time.time()
+    traces = []
+    try:
+        deadline = started + args.timeout
+        while time.time() < deadline and voter.poll() is None:
+            time.sleep(0.2)
+            if os.path.exists(timing_log):
+                with open(timing_log) as timings:
+                    traces = [json.loads(line) for line in timings if line.strip()]
+            if len(traces) >= args.rounds + args.warmup:
+                break
+    finally:
+        voter.terminate()
+        voter.wait()
+        log.close()
+    wall_time = time.time() - started
+
+    if voter.returncode not in (0, -15) and len(traces) < args.rounds + args.warmup:
+        print("voter exited early, see {}".format(log.name), file=sys.stderr)
+    if args.record and server.recorded:
+        with open(args.record, "w") as out:
+            json.dump(fixtures, out, indent=1)
+        print("recorded {} new responses to {}".format(len(server.recorded), args.record), file=sys.stderr)
+
+    boundaries = int((server.height - start_height) / 5)
+    return summarize(traces[args.warmup:], wall_time, boundaries), log.name
+
+
+def serve(args):
+    server = ReplayServer(json.load(open(args.fixtures)), args.block_time, port=args.port).start()
+    print("serving a block every {}s on {}".format(args.block_time, server.url))
+    print("voter settings: MOCK_LCD={0} (add HTTP_REPLAY_URL={0} to replay the exchanges too)".format(server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20, help="rounds to measure")
+    parser.add_argument("--warmup", type=int, default=1, help="rounds to discard before measuring")
+    parser.add_argument("--block-time", type=float, default=0.5, help="seconds between replayed blocks")
+    parser.add_argument("--timeout", type=float, default=600, help="give up after this many seconds")
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(VOTER), "round_benchmark_fixtures.json"))
+    parser.add_argument("--record", metavar="FILE", help="fetch missing responses upstream and save fixtures to FILE")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra voter setting")
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    parser.add_argument("--serve", action="store_true", help="only run the stand-in server until interrupted")
+    parser.add_argument("--port", type=int, help="port of the stand-in server (default: any free port)")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    summary, voter_log = run_benchmark(args)
+    if args.json:
+        print(json.dumps(summary, indent=1))
+    else:
+        print_summary(summary)
+        print("voter log: {}".format(voter_log))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,20 +14,34 @@ import multiprocessing
 import concurrent.futures
 import os
 import subprocess
+import tempfile
 import time
 import functools
+import itertools
+import collections
 import asyncio
+import threading
+import queue
+import datetime
+import math
+import struct
+from array import array
+from http.server import ThreadingHTTPServer
+
+# start of the start-up measurement (see StartupTimer)
+process_started_at = time.time()
 
 # External libraries - installation required:
 #  pip3 install --user -r requirements.txt
 #
 import requests
-from prometheus_client import start_http_server, Summary, Counter, Gauge, Histogram
+from prometheus_client import MetricsHandler, Summary, Counter, Gauge, Histogram
 import aiohttp
 import statistics
-from pyband.obi import PyObi
-from pyband.client import Client
-import binance.client
+import numpy as np
+import base64
+# pyband, bech32, bip32, coincurve and mnemonic are imported where they are
+# used, so a restart does not wait for them before the first block
 
 # User setup
 
@@ -37,11 +51,12 @@ telegram_token = os.getenv("TELEGRAM_TOKEN", "")
 telegram_chat_id = os.getenv("TELEGRAM_CHAT_ID", "")
 # https://www.alphavantage.co/
 alphavantage_key = os.getenv("ALPHAVANTAGE_KEY", "")
-# https://python-binance.readthedocs.io/
-binance_key = os.getenv("BINANCE_KEY","")
-binance_secret = os.getenv("BINANCE_SECRET","")
 # no using alphavantage
 fx_api_option = os.getenv("FX_API_OPTION", "alphavantage,free_api,band")
+# seconds between background refreshes of each FX provider
+fx_refresh_interval = os.getenv("FX_REFRESH_INTERVAL", "alphavantage:300,free_api:300,band:60")
+# seconds after which a cached FX rate is too stale to vote with
+fx_max_age = os.getenv("FX_MAX_AGE", "alphavantage:1800,free_api:1800,band:600")
 # stop oracle when price change exceeds stop_oracle_trigger
 stop_oracle_trigger_recent_diverge = float(os.getenv("STOP_ORACLE_RECENT_DIVERGENCE", "999999999999"))
 # stop oracle when price change exceeds stop_oracle_trigger
@@ -57,13 +72,44 @@ key_password = os.getenv("KEY_PASSWORD", "").encode()
 fee_denom = os.getenv("FEE_DENOM", "ukrw")
 fee_gas = os.getenv("FEE_GAS", "250000")
 fee_amount = os.getenv("FEE_AMOUNT", "500000")
+# simulate the gas of each tx shape once and size its fee; FEE_GAS/FEE_AMOUNT are used until then
+fee_simulate = os.getenv("FEE_SIMULATE", "true") == "true"
+# safety margin applied to the simulated gas
+fee_gas_adjustment = float(os.getenv("FEE_GAS_ADJUSTMENT", "1.4"))
+# fee per unit of gas in FEE_DENOM, by default the price FEE_AMOUNT/FEE_GAS implies
+fee_gas_price = float(os.getenv("FEE_GAS_PRICE", str(float(fee_amount) / float(fee_gas))))
+# seconds a simulated gas amount is used before the shape is simulated again (picks up chain upgrades)
+fee_simulate_max_age = float(os.getenv("FEE_SIMULATE_MAX_AGE", "3600"))
 home_cli = os.getenv("HOME_CLI", "/home/ubuntu/.terracli")
-# node to broadcast the txs
-node = os.getenv("NODE_RPC", "tcp://127.0.0.1:26657")
+# how votes are signed and broadcast: "terracli" (subprocess) or "native" (in-process, RPC broadcast_tx_sync)
+signing_mode = os.getenv("SIGNING_MODE", "terracli")
+# feeder key for native signing: hex private key, or mnemonic derived on the Terra HD path
+feeder_private_key = os.getenv("FEEDER_PRIVATE_KEY", "")
+feeder_mnemonic = os.getenv("FEEDER_MNEMONIC", "")
+feeder_hd_path = os.getenv("FEEDER_HD_PATH", "m/44'/330'/0'/0/0")
+# run the full loop but append the txs to DRY_RUN_LOG instead of signing and broadcasting them
+# (no alerts and no vote state, so it can run next to the production voter on another METRICS_PORT)
+dry_run = os.getenv("DRY_RUN", "false") == "true"
+dry_run_log = os.getenv("DRY_RUN_LOG", "dry_run.jsonl")
+# node to broadcast the txs (comma-separated for a failover pool)
+node_addresses = [address.strip() for address in os.getenv("NODE_RPC", "tcp://127.0.0.1:26657").split(",") if address.strip()]
+# follow new blocks through the NODE_RPC websocket (falls back to LCD polling while it is down)
+block_websocket = os.getenv("BLOCK_WEBSOCKET", "true") == "true"
+# seconds without a NewBlock event before the websocket is considered stalled
+block_stall_timeout = float(os.getenv("BLOCK_STALL_TIMEOUT", "15"))
 # path to terracli binary
 terracli = os.getenv("TERRACLI_BIN", "sudo /home/ubuntu/go/bin/terracli")
-# lcd to receive swap price information
-lcd_address = os.getenv("TERRA_LCD", "https://lcd.terra.dev")
+# lcd to receive swap price information (comma-separated for a failover pool)
+lcd_addresses = [address.strip().rstrip("/") for address in os.getenv("TERRA_LCD", "https://lcd.terra.dev").split(",") if address.strip()]
+# url of a stand-in LCD/RPC (python3 round_benchmark.py --serve) used instead of TERRA_LCD and NODE_RPC
+mock_lcd = os.getenv("MOCK_LCD", "").rstrip("/")
+if mock_lcd:
+    lcd_addresses = [mock_lcd + "/lcd"]
+    node_addresses = [mock_lcd]
+# seconds between background health probes of pooled LCD/RPC endpoints
+endpoint_probe_interval = float(os.getenv("ENDPOINT_PROBE_INTERVAL", "10"))
+# blocks an endpoint may trail the highest pooled endpoint before it is avoided
+endpoint_max_height_lag = int(os.getenv("ENDPOINT_MAX_HEIGHT_LAG", "2"))
 # default coinone weight
 coinone_share_default = float(os.getenv("COINONE_SHARE_DEFAULT", "1.0"))
 # default bithumb weight
@@ -73,17 +119,48 @@ gopax_share_default = float(os.getenv("GOPAX_SHARE_DEFAULT", "0"))
 # default gdac weight
 gdac_share_default = float(os.getenv("GDAC_SHARE_DEFAULT", "0"))
 price_divergence_alert = os.getenv("PRICE_ALERTS", "false") == "true"
+# seconds alerts are collected into one message before it is sent
+alert_batch_seconds = float(os.getenv("ALERT_BATCH_SECONDS", "2"))
+# seconds during which an alert of the same kind (e.g. the same denom diverging) is not repeated
+alert_dedupe_seconds = float(os.getenv("ALERT_DEDUPE_SECONDS", "300"))
+# minimum seconds between two messages to each alert sink
+alert_min_interval = os.getenv("ALERT_MIN_INTERVAL", "telegram:3,slack:1")
+# alerts waiting per sink; new ones are dropped when it is full
+alert_queue_size = int(os.getenv("ALERT_QUEUE_SIZE", "100"))
+# how the LUNA/KRW venues are combined: "weighted_median" or "trimmed_mean" (TRIM_FRACTION=0 is the plain weighted mean)
+aggregation_method = os.getenv("AGGREGATION_METHOD", "weighted_median")
+# share of the total venue weight cut from each tail by the trimmed mean
+trim_fraction = float(os.getenv("TRIM_FRACTION", "0.25"))
 vwma_period = int(os.getenv("VWMA_PERIOD", str(3 * 600)))  # in seconds
+# extra VWAP window lengths tracked alongside VWMA_PERIOD (exported as metrics)
+vwap_windows = [int(w) for w in os.getenv("VWAP_WINDOWS", "60,600").split(",") if w]
+# trades kept per exchange for the VWAP windows
+vwap_capacity = int(os.getenv("VWAP_CAPACITY", "8192"))
+# venues whose top of book is kept live in memory ("binance" streams bookTicker, the others are long-polled);
+# a streamed binance quotes the instantaneous book mid (also on its REST fallback) instead of the 5-minute avgPrice
+stream_books = [name for name in os.getenv("STREAM_BOOKS", "").split(",") if name]
+# seconds between order book polls of a streamed venue without a websocket feed
+stream_poll_interval = float(os.getenv("STREAM_POLL_INTERVAL", "1"))
+# seconds after which a streamed book is stale and the round fetches over REST instead
+stream_max_age = float(os.getenv("STREAM_MAX_AGE", "5"))
+binance_stream_url = os.getenv("BINANCE_STREAM_URL", "wss://stream.binance.com:9443/ws/lunausdt@bookTicker")
 misses = int(os.getenv("MISSES", "0"))
 alertmisses = os.getenv("MISS_ALERTS", "true") == "true"
 debug = os.getenv("DEBUG", "false") == "true"
 metrics_port = os.getenv("METRICS_PORT", "19000")
+# append per-round stage timings as json lines to this file (used by round_benchmark.py)
+round_timing_log = os.getenv("ROUND_TIMING_LOG", "")
+# number of recent round traces served as json on /rounds of the metrics port
+round_trace_buffer = int(os.getenv("ROUND_TRACE_BUFFER", "50"))
+# send requests for hardcoded exchange/FX hosts to {HTTP_REPLAY_URL}/{host}/{path} (used by round_benchmark.py)
+http_replay_url = os.getenv("HTTP_REPLAY_URL", "").rstrip("/")
 band_endpoint = os.getenv("BAND_ENDPOINT", "https://terra-lcd.bandchain.org")
 band_luna_price_params = os.getenv("BAND_LUNA_PRICE_PARAMS", "13,1_000_000_000,10,16")
 
 METRIC_MISSES = Gauge("terra_oracle_misses_total", "Total number of oracle misses")
 METRIC_HEIGHT = Gauge("terra_oracle_height", "Block height of the LCD node")
 METRIC_VOTES = Counter("terra_oracle_votes", "Counter of oracle votes")
+METRIC_VALIDATOR_MISSES = Gauge("terra_oracle_validator_misses", "Oracle misses of each validator", ["validator"])
 
 METRIC_MARKET_PRICE = Gauge("terra_oracle_market_price", "Last market price", ['denom'])
 METRIC_SWAP_PRICE = Gauge("terra_oracle_swap_price", "Last swap price", ['denom'])
@@ -91,13 +168,41 @@ METRIC_SWAP_PRICE = Gauge("terra_oracle_swap_price", "Last swap price", ['denom'
 METRIC_EXCHANGE_ASK_PRICE = Gauge("terra_oracle_exchange_ask_price", "Exchange ask price", ['exchange', 'denom'])
 METRIC_EXCHANGE_MID_PRICE = Gauge("terra_oracle_exchange_mid_price", "Exchange mid price", ['exchange', 'denom'])
 METRIC_EXCHANGE_BID_PRICE = Gauge("terra_oracle_exchange_bid_price", "Exchange bid price", ['exchange', 'denom'])
+METRIC_EXCHANGE_VWAP = Gauge("terra_oracle_exchange_vwap", "Exchange VWAP over a trailing window", ['exchange', 'window'])
+
+METRIC_SOURCE_DROPPED = Counter("terra_oracle_source_dropped", "Venues left out of the LUNA price aggregate", ["exchange", "reason"])
+
+METRIC_ALERTS_SENT = Counter("terra_oracle_alerts_sent", "Alert messages sent (after batching)", ["sink"])
+METRIC_ALERTS_FAILED = Counter("terra_oracle_alerts_failed", "Alert messages the sink failed to send", ["sink"])
+METRIC_ALERTS_DROPPED = Counter("terra_oracle_alerts_dropped", "Alerts not sent", ["sink", "reason"])
+
+METRIC_ACCOUNT_SYNCS = Counter("terra_oracle_account_syncs", "Account number/sequence queries of a feeder", ["feeder"])
 
 METRIC_OUTBOUND_ERROR = Counter("terra_oracle_request_errors", "Outbound HTTP request error count", ["remote"])
 METRIC_OUTBOUND_LATENCY = Histogram("terra_oracle_request_latency", "Outbound HTTP request latency", ["remote"])
 
+METRIC_FX_AGE = Gauge("terra_oracle_fx_age_seconds", "Age of the cached FX rates", ["provider"])
+METRIC_BOOK_AGE = Gauge("terra_oracle_book_age_seconds", "Age of a streamed top of book when a round read it", ["exchange"])
+METRIC_BOOK_UPDATES = Counter("terra_oracle_book_updates", "Top of book updates received from a streamed venue", ["exchange"])
+METRIC_FETCH_HEDGED = Counter("terra_oracle_fetch_hedged", "Duplicate requests sent to a slow source", ["remote"])
+METRIC_FETCH_CANCELLED = Counter("terra_oracle_fetch_cancelled", "Fetches cancelled at the round deadline", ["remote"])
+METRIC_ENDPOINT_LATENCY = Gauge("terra_oracle_endpoint_latency_seconds", "Moving average latency of a pooled endpoint", ["pool", "endpoint"])
+METRIC_ENDPOINT_HEIGHT = Gauge("terra_oracle_endpoint_height", "Last block height reported by a pooled endpoint", ["pool", "endpoint"])
+METRIC_ENDPOINT_HEALTHY = Gauge("terra_oracle_endpoint_healthy", "1 when a pooled endpoint is healthy and not lagging", ["pool", "endpoint"])
+METRIC_ENDPOINT_ERRORS = Counter("terra_oracle_endpoint_errors", "Failed requests to a pooled endpoint", ["pool", "endpoint"])
+METRIC_BLOCK_INTERVAL = Gauge("terra_oracle_block_interval_seconds", "Moving average of the time between blocks")
+
+ROUND_STAGE_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+METRIC_ROUND_STAGE = Histogram("terra_oracle_round_stage_seconds", "Time spent in each stage of a vote round",
+                               ["stage", "outcome"], buckets=ROUND_STAGE_BUCKETS)
+METRIC_ROUND_DURATION = Histogram("terra_oracle_round_seconds", "Time from the boundary block to the broadcast",
+                                  ["outcome"], buckets=ROUND_STAGE_BUCKETS)
+METRIC_BROADCAST_LAG = Histogram("terra_oracle_broadcast_lag_seconds", "Time from the boundary block timestamp to the broadcast",
+                                 buckets=ROUND_STAGE_BUCKETS)
+METRIC_STARTUP_STAGE = Gauge("terra_oracle_startup_stage_seconds", "Time spent in each start-up stage", ["stage"])
+METRIC_STARTUP = Gauge("terra_oracle_startup_seconds", "Time from start-up to the first block of every chain")
+METRIC_BLOCKS_REMAINING = Gauge("terra_oracle_blocks_remaining_at_broadcast", "Blocks left in the vote period when the round was broadcast")
 
-#  binance client
-binance_client = binance.client.Client(binance_key, binance_secret)
 # parameters
 fx_map = {
     "uusd": "USDUSD",
@@ -162,12 +267,22 @@ abstain_set = [
 ]
 
 chain_id = os.getenv("CHAIN_ID", "columbus-4")
+# json list of validators voting from this process; keys not given default to the settings above
+# (name, validator, feeder, key_name, key_password, home_cli, chain_id, signing_mode, feeder_private_key,
+#  feeder_mnemonic, feeder_hd_path, terra_lcd, node_rpc, misses)
+validators_file = os.getenv("VALIDATORS_FILE", "")
+# append-only file keeping each validator's pending prevote (salts) across restarts; empty disables
+vote_state_file = os.getenv("VOTE_STATE_FILE", "vote_state.jsonl")
+# seconds exchange/Band quotes are reused by the round of another chain
+market_max_age = float(os.getenv("MARKET_MAX_AGE", "5"))
+# samples kept in memory per price series (source quotes, FX, swap and voted prices)
+price_history_capacity = int(os.getenv("PRICE_HISTORY_CAPACITY", "2880"))
+# binary append-only archive of every recorded price (see load_price_archive); empty disables
+price_archive_file = os.getenv("PRICE_ARCHIVE_FILE", "")
 round_block_num = 5.0
+# fetch, aggregate and sign this many blocks before the round boundary (0 disables, at most 3)
+pipeline_lead_blocks = min(int(os.getenv("PIPELINE_LEAD_BLOCKS", "1")), 3)
 
-# set last update time
-last_height = 0
-
-logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
 logger = logging.root
 
 # By default, python-requests does not use a timeout. We need to specify
@@ -177,6 +292,18 @@ http_timeout = 4
 # Separate timeout for alerting calls
 alert_http_timeout = 4
 
+# Expected seconds between blocks until enough blocks have been seen to measure it
+block_interval_default = 6.0
+# Part of a block interval the round may spend fetching prices; stragglers are cancelled after it
+fetch_budget_blocks = float(os.getenv("FETCH_BUDGET_BLOCKS", "0.5"))
+# Send a duplicate request to a source once it is slower than this percentile of its recent latencies
+fetch_hedge_percentile = float(os.getenv("FETCH_HEDGE_PERCENTILE", "90"))
+
+# Pooled keep-alive connections per remote host for the async fetchers
+async_limit_per_host = int(os.getenv("ASYNC_LIMIT_PER_HOST", "16"))
+# Seconds an idle pooled connection is kept open (covers the gap between rounds)
+async_keepalive_timeout = float(os.getenv("ASYNC_KEEPALIVE_TIMEOUT", "120"))
+
 # Global requests session for HTTP/1.1 keepalive
 # (unfortunately, the timeout cannot be set globally)
 session = requests.session()
@@ -184,20 +311,236 @@ session = requests.session()
 # Be friendly to the APIs we use and specify a user-agent
 session.headers['User-Agent'] = "bharvest-oracle-voter/0 (+https://github.com/b-harvest/terra_oracle_voter)"
 
-# Start metrics server in a background thread
-start_http_server(int(metrics_port))
+# recent RoundTrace.as_dict() entries, newest last
+recent_rounds = collections.deque(maxlen=round_trace_buffer)
+
+
+class OracleMetricsHandler(MetricsHandler):
+    """Prometheus metrics, plus the recent round traces as json on /rounds."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/rounds":
+            return MetricsHandler.do_GET(self)
+        output = json.dumps(list(recent_rounds)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(("", port), OracleMetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+
+class AsyncRuntime:
+    """One event loop thread and one pooled aiohttp session for the life of the process."""
+
+    def __init__(self, limit_per_host, keepalive_timeout):
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.loop = None
+        self.session = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, name="async-runtime", daemon=True)
+        self.thread.start()
+        self.session = self.run(self._create_session(self.limit_per_host, self.keepalive_timeout))
+        return self
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _create_session(self, limit_per_host, keepalive_timeout):
+        connector = aiohttp.TCPConnector(
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=300)
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers={'User-Agent': session.headers['User-Agent']},
+            timeout=aiohttp.ClientTimeout(total=http_timeout))
+
+    def submit(self, coro):
+        """Schedules a coroutine on the runtime loop and returns a concurrent future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Runs a coroutine on the runtime loop and blocks until it is done."""
+        return self.submit(coro).result(timeout)
+
+
+# Shared async HTTP layer: keeps TCP/TLS connections warm between rounds (started by main())
+async_runtime = AsyncRuntime(async_limit_per_host, async_keepalive_timeout)
+
+
+async def gather_fx(fetch, symbols):
+    return await asyncio.gather(*[fetch(symbol) for symbol in symbols])
+
+
+def outbound_url(url):
+    """Returns url, or its replay-server equivalent when HTTP_REPLAY_URL is set."""
+    if not http_replay_url:
+        return url
+    return http_replay_url + "/" + url.split("://", 1)[-1]
+
 
 def time_request(remote):
     """Returns a decorator that measures execution time."""
     return METRIC_OUTBOUND_LATENCY.labels(remote).time()
 
+class Endpoint:
+    """Health of one pooled node."""
+
+    def __init__(self, address, url):
+        self.address = address
+        self.url = url
+        self.latency = None
+        self.failures = 0
+        self.height = 0
+
+
+class EndpointPool:
+    """Sends each request to the fastest healthy node of several equivalent ones.
+
+    Latency is a moving average over requests and background probes. A node
+    that failed max_failures times in a row, or whose height trails the best
+    node by more than max_height_lag blocks, is only tried after the others,
+    so a request fails over within the same round.
+    """
+
+    def __init__(self, name, addresses, url=lambda address: address, probe_path="", parse_height=None,
+                 max_height_lag=2, max_failures=3):
+        self.name = name
+        self.endpoints = [Endpoint(address, url(address)) for address in addresses]
+        self.probe_path = probe_path
+        self.parse_height = parse_height
+        self.max_height_lag = max_height_lag
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+
+    def start(self, probe_interval):
+        """Probes every endpoint in the background (only worth it with more than one)."""
+        if len(self.endpoints) > 1:
+            threading.Thread(target=self._probe_forever, args=(probe_interval,),
+                             name=self.name + "-probe", daemon=True).start()
+        return self
+
+    def _probe_forever(self, probe_interval):
+        while True:
+            for endpoint in self.endpoints:
+                try:
+                    self._request(endpoint, "GET", self.probe_path)
+                except Exception:
+                    logger.debug("%s probe of %s failed", self.name, endpoint.address, exc_info=True)
+            time.sleep(probe_interval)
+
+    def best_height(self):
+        return max(endpoint.height for endpoint in self.endpoints)
+
+    def lagging(self, endpoint):
+        return endpoint.height + self.max_height_lag < self.best_height()
+
+    def healthy(self, endpoint):
+        return endpoint.failures < self.max_failures and not self.lagging(endpoint)
+
+    def ranked(self):
+        """Endpoints in the order they should be tried."""
+        with self.lock:
+            return sorted(self.endpoints, key=lambda endpoint: (
+                not self.healthy(endpoint),
+                endpoint.latency if endpoint.latency is not None else http_timeout))
+
+    def best(self):
+        return self.ranked()[0].address
+
+    def _record(self, endpoint, latency=None, height=None):
+        with self.lock:
+            if latency is None:
+                endpoint.failures += 1
+                METRIC_ENDPOINT_ERRORS.labels(self.name, endpoint.address).inc()
+            else:
+                endpoint.failures = 0
+                endpoint.latency = latency if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * latency
+                METRIC_ENDPOINT_LATENCY.labels(self.name, endpoint.address).set(endpoint.latency)
+            if height is not None and height > endpoint.height:
+                endpoint.height = height
+                METRIC_ENDPOINT_HEIGHT.labels(self.name, endpoint.address).set(height)
+            for each in self.endpoints:
+                METRIC_ENDPOINT_HEALTHY.labels(self.name, each.address).set(1 if self.healthy(each) else 0)
+
+    def _request(self, endpoint, method, path, **kwargs):
+        started = time.time()
+        try:
+            result = session.request(method, endpoint.url + path, timeout=http_timeout, **kwargs).json()
+        except Exception:
+            self._record(endpoint)
+            raise
+        height = None
+        if self.parse_height is not None:
+            try:
+                height = int(self.parse_height(result))
+            except (KeyError, TypeError, ValueError):
+                pass
+        self._record(endpoint, time.time() - started, height)
+        return result
+
+    def request(self, method, path, **kwargs):
+        """Returns the json result of the first endpoint that answers and is not behind."""
+        error = None
+        behind = None
+        for endpoint in self.ranked():
+            try:
+                result = self._request(endpoint, method, path, **kwargs)
+            except Exception as e:
+                logger.warning("%s request %s to %s failed: %r", self.name, path, endpoint.address, e)
+                error = e
+                continue
+            if self.lagging(endpoint):
+                logger.warning("%s endpoint %s is at height %d, behind %d; trying the next one",
+                               self.name, endpoint.address, endpoint.height, self.best_height())
+                behind = behind or result
+                continue
+            return result
+        if behind is not None:
+            return behind
+        raise error
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+def lcd_height(result):
+    """Height of a legacy LCD response ({"height": .., "result": ..}) or of /blocks/latest."""
+    if "height" in result:
+        return result["height"]
+    return result["block"]["header"]["height"]
+
+
+def rpc_height(result):
+    return result["result"]["sync_info"]["latest_block_height"]
+
+
 @time_request('telegram')
 def telegram(message):
+    """Sends message to the Telegram chat; returns whether it was accepted."""
     if not telegram_token:
-        return
+        return False
 
     try:
-        requests.post(
+        response = requests.post(
             "https://api.telegram.org/bot{}/sendMessage".format(telegram_token),
             json={
                 'chat_id': telegram_chat_id,
@@ -205,26 +548,144 @@ def telegram(message):
             },
             timeout=alert_http_timeout
         )
+        response.raise_for_status()
+        return True
     except:
+        METRIC_OUTBOUND_ERROR.labels('telegram').inc()
         logging.exception("Error while sending telegram alert")
+        return False
 
 @time_request('slack')
 def slack(message):
+    """Posts message to the Slack webhook; returns whether it was accepted."""
     if not slackurl:
-        return
+        return False
 
     try:
-        requests.post(slackurl, json={"text": message}, timeout=alert_http_timeout)
+        requests.post(slackurl, json={"text": message}, timeout=alert_http_timeout).raise_for_status()
+        return True
     except:
         METRIC_OUTBOUND_ERROR.labels('slack').inc()
         logging.exception("Error while sending Slack alert")
+        return False
+
+
+def parse_provider_seconds(spec):
+    """Parses "provider:seconds,provider:seconds" settings."""
+    result = {}
+    for item in spec.split(","):
+        if item:
+            provider, _, seconds = item.partition(":")
+            result[provider.strip()] = float(seconds)
+    return result
+
+
+class AlertSink:
+    """One alert destination, sent to from its own worker thread.
+
+    Alerts queued within batch_window of the first one go out as a single
+    message (repeated lines once), at least min_interval after the previous
+    message. When the queue is full new alerts are dropped, never waited on.
+    send(message) returns whether the destination accepted the message.
+    """
+
+    def __init__(self, name, send, min_interval, batch_window, queue_size, max_length=4000):
+        self.name = name
+        self.send = send
+        self.min_interval = min_interval
+        self.batch_window = batch_window
+        self.max_length = max_length
+        self.queue = queue.Queue(queue_size)
+        self.last_sent = 0.0
+
+    def start(self):
+        threading.Thread(target=self._send_forever, name="alert-" + self.name, daemon=True).start()
+        return self
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            METRIC_ALERTS_DROPPED.labels(self.name, "queue_full").inc()
+            logger.warning("Alert queue of %s is full, dropping: %s", self.name, message)
+
+    def _collect(self, lines, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                lines.append(self.queue.get(timeout=deadline - time.time()))
+            except queue.Empty:
+                return
+
+    def _send_forever(self):
+        while True:
+            lines = [self.queue.get()]
+            self._collect(lines, self.batch_window)
+            # alerts arriving while the rate limit holds the message back join it
+            self._collect(lines, self.last_sent + self.min_interval - time.time())
+            message = "\n".join(collections.OrderedDict.fromkeys(lines))
+            if len(message) > self.max_length:
+                message = message[:self.max_length] + "\n(truncated)"
+            try:
+                sent = self.send(message)
+            except:
+                logger.exception("Error while sending %s alert", self.name)
+                sent = False
+            if sent:
+                METRIC_ALERTS_SENT.labels(self.name).inc()
+            else:
+                METRIC_ALERTS_FAILED.labels(self.name).inc()
+            self.last_sent = time.time()
+
+
+class AlertDispatcher:
+    """Hands alerts to every sink without blocking the caller.
+
+    An alert whose key was already alerted within dedupe_window is
+    suppressed; the key defaults to the message itself.
+    """
+
+    def __init__(self, sinks, dedupe_window):
+        self.sinks = sinks
+        self.dedupe_window = dedupe_window
+        self.last_alerted = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+        return self
+
+    def alert(self, message, key=None):
+        key = message if key is None else key
+        now = time.time()
+        with self.lock:
+            if now - self.last_alerted.get(key, float("-inf")) < self.dedupe_window:
+                METRIC_ALERTS_DROPPED.labels("all", "duplicate").inc()
+                return
+            self.last_alerted[key] = now
+            if len(self.last_alerted) > 1000:
+                self.last_alerted = {alerted_key: alerted_at for alerted_key, alerted_at in self.last_alerted.items()
+                                     if now - alerted_at < self.dedupe_window}
+        for sink in self.sinks:
+            sink.put(message)
+
+
+alert_min_intervals = parse_provider_seconds(alert_min_interval)
+alert_sinks = []
+if telegram_token and not dry_run:
+    alert_sinks.append(AlertSink("telegram", telegram, alert_min_intervals.get("telegram", 3),
+                                 alert_batch_seconds, alert_queue_size))
+if slackurl and not dry_run:
+    alert_sinks.append(AlertSink("slack", slack, alert_min_intervals.get("slack", 1),
+                                 alert_batch_seconds, alert_queue_size))
+# alert workers are started by main()
+alerts = AlertDispatcher(alert_sinks, alert_dedupe_seconds)
 
 @time_request('lcd')
-def get_current_misses():
+def get_current_misses(v):
     try:
-        result = session.get(
-            "{}/oracle/voters/{}/miss".format(lcd_address, validator),
-            timeout=http_timeout).json()
+        result = v.chain.lcd_pool.get("/oracle/voters/{}/miss".format(v.validator))
         misses = int(result["result"])
         height = int(result["height"])
         return misses, height
@@ -236,9 +697,7 @@ def get_current_misses():
 @time_request('lcd')
 def get_current_prevotes(denom):
     try:
-        return session.get(
-            "{}/oracle/denoms/{}/prevotes".format(lcd_address, denom),
-            timeout=http_timeout).json()
+        return lcd_pool.get("/oracle/denoms/{}/prevotes".format(denom))
     except:
         METRIC_OUTBOUND_ERROR.labels('lcd').inc()
         logging.exception("Error in get_current_prevotes")
@@ -247,9 +706,7 @@ def get_current_prevotes(denom):
 @time_request('lcd')
 def get_current_votes(denom):
     try:
-        result = session.get(
-            "{}/oracle/denoms/{}/votes".format(lcd_address, denom),
-            timeout=http_timeout).json()
+        result = lcd_pool.get("/oracle/denoms/{}/votes".format(denom))
         return result
     except:
         METRIC_OUTBOUND_ERROR.labels('lcd').inc()
@@ -257,14 +714,12 @@ def get_current_votes(denom):
         return False
 
 @time_request('lcd')
-def get_my_current_prevotes():
+def get_my_current_prevotes(v):
     try:
-        result = session.get(
-            "{}/oracle/voters/{}/prevotes".format(lcd_address, validator),
-            timeout=http_timeout).json()
+        result = v.chain.lcd_pool.get("/oracle/voters/{}/prevotes".format(v.validator))
         result_vote = []
         for vote in result["result"]:
-            if str(vote["voter"]) == str(validator):
+            if str(vote["voter"]) == str(v.validator):
                 result_vote.append(vote)
         return result_vote
     except:
@@ -272,12 +727,30 @@ def get_my_current_prevotes():
         logging.exception("Error in get_my_current_prevotes")
         return False
 
+@time_request('lcd')
+def get_tx_result(txhash, pool):
+    """The DeliverTx outcome of a tx as {"code", "height", "raw_log"}; None until it is in a block, False on error."""
+    try:
+        result = pool.get("/txs/{}".format(txhash))
+    except:
+        METRIC_OUTBOUND_ERROR.labels('lcd').inc()
+        logging.exception("Error in get_tx_result")
+        return False
+    if "txhash" not in result:
+        # {"error": "... not found"} until the tx is indexed
+        return None
+    return {
+        "code": int(result.get("code", 0) or 0),
+        "height": int(result.get("height", 0) or 0),
+        "raw_log": result.get("raw_log", "")
+    }
+
 # get latest block info
 @time_request('lcd')
-def get_latest_block():
+def get_latest_block(pool=None):
     err_flag = False
     try:
-        result = session.get("{}/blocks/latest".format(lcd_address), timeout=http_timeout).json()
+        result = (pool or lcd_pool).get("/blocks/latest")
         latest_block_height = int(result["block"]["header"]["height"])
         latest_block_time = result["block"]["header"]["time"]
     except:
@@ -289,6 +762,168 @@ def get_latest_block():
 
     return err_flag, latest_block_height, latest_block_time
 
+
+def parse_block_time(block_time):
+    """Unix time of a Tendermint RFC 3339 block timestamp (nanoseconds are truncated)."""
+    seconds, _, fraction = block_time.rstrip("Z").partition(".")
+    timestamp = datetime.datetime.strptime(seconds, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+    return timestamp.timestamp() + float("0." + (fraction[:6] or "0"))
+
+
+def rpc_websocket_url(rpc_address):
+    """Maps a NODE_RPC address (tcp://, http://, https://) to its Tendermint websocket endpoint."""
+    address = rpc_address.rstrip("/")
+    for scheme, ws_scheme in (("tcp://", "ws://"), ("http://", "ws://"), ("https://", "wss://")):
+        if address.startswith(scheme):
+            address = ws_scheme + address[len(scheme):]
+            break
+    return address + "/websocket"
+
+
+def rpc_http_url(rpc_address):
+    """Maps a NODE_RPC address (tcp://, http://, https://) to its JSON-RPC http endpoint."""
+    address = rpc_address.rstrip("/")
+    if address.startswith("tcp://"):
+        address = "http://" + address[len("tcp://"):]
+    return address
+
+
+lcd_pool = EndpointPool("lcd", lcd_addresses, probe_path="/blocks/latest", parse_height=lcd_height,
+                        max_height_lag=endpoint_max_height_lag)
+rpc_pool = EndpointPool("rpc", node_addresses, url=rpc_http_url, probe_path="/status", parse_height=rpc_height,
+                        max_height_lag=endpoint_max_height_lag)
+
+
+class BlockSource:
+    """Follows new block heights from the Tendermint NewBlock subscription.
+
+    While the subscription is down (or stalled) heights are polled from the LCD
+    with `poll`, so callers always get the same (err_flag, height, time) tuple
+    as get_latest_block(). ws_url may be a callable, evaluated on every
+    (re)connect. Tx events matching any of tx_queries are also subscribed to
+    and their TxResult is passed to on_tx (on the runtime loop).
+    """
+
+    subscribe_request = {
+        "jsonrpc": "2.0",
+        "method": "subscribe",
+        "id": 0,
+        "params": {"query": "tm.event='NewBlock'"}
+    }
+
+    def __init__(self, runtime, ws_url, poll=get_latest_block, poll_interval=1, stall_timeout=15,
+                 max_backoff=30, tx_queries=(), on_tx=None):
+        self.runtime = runtime
+        self.ws_url = ws_url
+        self.tx_queries = list(tx_queries)
+        self.on_tx = on_tx
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+        self.max_backoff = max_backoff
+        self.connected = False
+        self.ws = None
+        self.latest_height = None
+        self.latest_time = None
+        self.block_interval = block_interval_default
+        self.condition = threading.Condition()
+
+    def start(self):
+        self.runtime.submit(self._subscribe_forever())
+        return self
+
+    async def _subscribe_forever(self):
+        backoff = 1
+        while True:
+            ws_url = self.ws_url() if callable(self.ws_url) else self.ws_url
+            try:
+                async with self.runtime.session.ws_connect(ws_url, heartbeat=10) as ws:
+                    self.ws = ws
+                    await ws.send_json(self.subscribe_request)
+                    for subscription_id, tx_query in enumerate(self.tx_queries, 1):
+                        await ws.send_json(dict(self.subscribe_request, id=subscription_id, params={"query": tx_query}))
+                    logger.info("Subscribed to NewBlock events on %s", ws_url)
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        event_type, value = self._parse_event(msg.data)
+                        if event_type == "tendermint/event/NewBlock":
+                            header = value["block"]["header"]
+                            backoff = 1
+                            self._publish(int(header["height"]), header["time"], connected=True)
+                        elif event_type == "tendermint/event/Tx" and self.on_tx is not None:
+                            self.on_tx(value["TxResult"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                METRIC_OUTBOUND_ERROR.labels('rpc-websocket').inc()
+                logger.warning("NewBlock subscription error on %s", ws_url, exc_info=True)
+            self.ws = None
+            with self.condition:
+                self.connected = False
+                self.condition.notify_all()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _close_stalled(self):
+        """Drops a subscription that stopped delivering blocks, so _subscribe_forever reconnects."""
+        if self.ws is not None:
+            await self.ws.close()
+
+    @staticmethod
+    def _parse_event(data):
+        try:
+            event = json.loads(data)["result"]["data"]
+            return event["type"], event["value"]
+        except (ValueError, KeyError, TypeError):
+            # subscription acks carry no event
+            return None, None
+
+    def _publish(self, height, block_time, connected=None):
+        with self.condition:
+            if connected is not None:
+                self.connected = connected
+            if self.latest_height is None or height > self.latest_height:
+                if self.latest_height is not None:
+                    self._update_interval(height, block_time)
+                self.latest_height = height
+                self.latest_time = block_time
+            self.condition.notify_all()
+
+    def _update_interval(self, height, block_time):
+        try:
+            interval = (parse_block_time(block_time) - parse_block_time(self.latest_time)) / (
+                height - self.latest_height)
+        except (ValueError, TypeError, AttributeError):
+            return
+        if interval > 0:
+            self.block_interval = 0.8 * self.block_interval + 0.2 * interval
+            METRIC_BLOCK_INTERVAL.set(self.block_interval)
+
+    def wait_for_block(self, last_height):
+        """Returns as soon as a block above last_height is known."""
+        with self.condition:
+            deadline = time.time() + self.stall_timeout
+            while self.connected:
+                if self.latest_height is not None and self.latest_height > last_height:
+                    return False, self.latest_height, self.latest_time
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.warning("No NewBlock event for %gs, polling LCD until the subscription recovers",
+                                   self.stall_timeout)
+                    # poll every poll_interval from now on; the next NewBlock event sets connected again
+                    self.connected = False
+                    self.runtime.submit(self._close_stalled())
+                    break
+                self.condition.wait(remaining)
+
+        err_flag, height, block_time = self.poll()
+        if not err_flag:
+            self._publish(height, block_time)
+        if err_flag or height <= last_height:
+            time.sleep(self.poll_interval)
+        return err_flag, height, block_time
+
 '''Option, receive sdr with paid service switch.
 # get real sdr rates
 @time_request('imf')
@@ -311,36 +946,32 @@ def get_sdr_rate():
 # get currency rate async def
 async def fx_for(symbol_to):
     try:
-        async with aiohttp.ClientSession() as async_session:
-            async with  async_session.get(
-            "https://www.alphavantage.co/query",
-            timeout=http_timeout,
-                params={
+        async with async_runtime.session.get(
+            outbound_url("https://www.alphavantage.co/query"),
+            params={
                 'function': 'CURRENCY_EXCHANGE_RATE',
                 'from_currency': 'USD',
                 'to_currency': symbol_to,
                 'apikey': alphavantage_key
-                }
-            ) as response:
-                api_result = await response.json(content_type=None)
-            return api_result
+            }
+        ) as response:
+            api_result = await response.json(content_type=None)
+        return api_result
     except:
             print("for_fx_error")
 
 # get currency rate async def
 async def fx_for_free(symbol_to):
     try:
-        async with aiohttp.ClientSession() as async_session:
-            async with  async_session.get(
-            "https://api.exchangerate.host/latest",
-            timeout=http_timeout,
-                params={
+        async with async_runtime.session.get(
+            outbound_url("https://api.exchangerate.host/latest"),
+            params={
                 'base': 'USD',
                 'symbols': symbol_to
-                }
-            ) as response:
-                api_result = await response.json(content_type=None)
-            return api_result
+            }
+        ) as response:
+            api_result = await response.json(content_type=None)
+        return api_result
     except:
             print("for_fx_error")
 
@@ -367,10 +998,7 @@ def get_fx_rate():
             "THB"
         ]
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        futures = [fx_for(symbol_lists) for symbol_lists in symbol_list]
-        api_result = loop.run_until_complete(asyncio.gather(*futures))
+        api_result = async_runtime.run(gather_fx(fx_for, symbol_list))
 
         result_real_fx = {
             "USDUSD": 1.0,
@@ -405,23 +1033,113 @@ def get_fx_rate():
 
     return err_flag, result_real_fx
 
+def build_obi(schema):
+    from pyband.obi import PyObi
+    return PyObi(schema)
+
+
+class BandDataSource:
+    """LUNA and FX lookups on BandChain.
+
+    The oracle-script schema and its PyObi codec are resolved once and kept
+    until the script id changes; requests go through the pooled async session
+    with its timeouts.
+    """
+
+    fx_symbols = ["KRW", "EUR", "CNY", "JPY", "XDR", "MNT", "GBP", "INR", "CAD", "CHF", "HKD", "AUD", "SGD", "THB"]
+    luna_exchanges = ["binance", "huobipro", "coinone", "bithumb", "gdac", "gopax"]
+
+    def __init__(self, runtime, endpoint):
+        self.runtime = runtime
+        self.endpoint = endpoint
+        self.oracle_script_id = None
+        self.obi = None
+        # created on the runtime loop, where every lookup runs
+        self.codec_lock = None
+
+    async def _get_result(self, path, params=None):
+        async with self.runtime.session.get(self.endpoint + path, params=params) as response:
+            response.raise_for_status()
+            return (await response.json(content_type=None))["result"]
+
+    async def _post_result(self, path, body):
+        async with self.runtime.session.post(self.endpoint + path, json=body) as response:
+            response.raise_for_status()
+            return (await response.json(content_type=None))["result"]
+
+    async def codec(self, oracle_script_id):
+        if self.codec_lock is None:
+            self.codec_lock = asyncio.Lock()
+        async with self.codec_lock:
+            if self.obi is None or self.oracle_script_id != oracle_script_id:
+                oracle_script = await self._get_result("/oracle/oracle_scripts/{}".format(oracle_script_id))
+                # importing pyband takes over a second; keep it off the loop the exchange fetches run on
+                self.obi = await asyncio.get_running_loop().run_in_executor(None, build_obi, oracle_script["schema"])
+                self.oracle_script_id = oracle_script_id
+                logger.info("Cached Band oracle script %d schema", oracle_script_id)
+            return self.obi
+
+    def warm(self, params):
+        """Resolves the codec of the LUNA price script in the background, before the first round needs it."""
+        oracle_script_id = int(params.split(",")[0], 10)
+
+        async def warm():
+            try:
+                await self.codec(oracle_script_id)
+            except:
+                logger.exception("Error while loading the Band oracle script %d", oracle_script_id)
+        return self.runtime.submit(warm())
+
+    async def luna_prices(self, params):
+        """Returns a LUNA/KRW Quote (or None) for each of luna_exchanges."""
+        oracle_script_id, multiplier, min_count, ask_count = [int(param, 10) for param in params.split(",")]
+        obi = await self.codec(oracle_script_id)
+        request = await self._get_result("/oracle/request_search", params={
+            "oid": oracle_script_id,
+            "calldata": obi.encode_input({"multiplier": multiplier}).hex(),
+            "min_count": min_count,
+            "ask_count": ask_count
+        })
+        result = obi.decode_output(base64.b64decode(request["result"]["response_packet_data"]["result"]))
+        band_quotes = {}
+        for (order_book, ex) in zip(result['prices'], self.luna_exchanges):
+            band_quotes[ex] = None
+            if order_book['ask'] > 0 and order_book['bid'] > 0 and order_book['mid'] > 0:
+                band_quotes[ex] = Quote(
+                    f"band_{ex}", "ukrw",
+                    order_book['ask']/multiplier,
+                    order_book['bid']/multiplier,
+                    order_book['mid']/multiplier)
+        return band_quotes
+
+    async def fx_rates(self):
+        prices = await self._post_result(
+            "/oracle/request_prices",
+            {"symbols": self.fx_symbols, "min_count": 10, "ask_count": 16})
+        result_real_fx = {"USDUSD": 1.0}
+        for (symbol, price) in zip(self.fx_symbols, prices):
+            if symbol == "XDR":
+                symbol = "SDR"
+            result_real_fx["USD"+symbol] = int(price['multiplier'],10) / int(price['px'],10)
+        return result_real_fx
+
+    def fetch(self, *lookups):
+        """Runs several lookups (coroutines of this source) concurrently and returns their results."""
+        async def gather():
+            return await asyncio.gather(*lookups)
+        return self.runtime.run(gather())
+
+
+band_data_source = BandDataSource(async_runtime, band_endpoint)
+
+
 #"fx_for" has been merged.
 @time_request('band-fx')
 def get_fx_rate_from_band():
     err_flag = False
     result_real_fx = None
     try:
-        result_real_fx = {"USDUSD": 1.0}
-        symbol_list = ["KRW","EUR","CNY","JPY","XDR","MNT","GBP","INR","CAD","CHF","HKD","AUD","SGD","THB"]
-        prices = requests.post(
-            f"{band_endpoint}/oracle/request_prices",
-            json={"symbols": symbol_list, "min_count": 10,"ask_count": 16}
-        ).json()['result']
-
-        for (symbol, price) in zip(symbol_list,prices):
-            if symbol == "XDR":
-                symbol = "SDR"
-            result_real_fx["USD"+symbol] = int(price['multiplier'],10) / int(price['px'],10)
+        result_real_fx, = band_data_source.fetch(band_data_source.fx_rates())
     except:
         METRIC_OUTBOUND_ERROR.labels('band-fx').inc()
         logger.exception("Error in def get_fx_rate_from_band")
@@ -452,10 +1170,7 @@ def get_fx_rate_free():
             "THB"
         ]
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        futures = [fx_for_free(symbol_lists) for symbol_lists in symbol_list]
-        api_result = loop.run_until_complete(asyncio.gather(*futures))
+        api_result = async_runtime.run(gather_fx(fx_for_free, symbol_list))
 
         result_real_fx = {
             "USDUSD": 1.0,
@@ -492,6 +1207,82 @@ def get_fx_rate_free():
     return err_flag, result_real_fx
 
 
+class FxCache:
+    """Keeps the latest rates of each FX provider, refreshed in the background.
+
+    Each provider runs on its own schedule; rounds read the cached rates
+    without any network I/O.
+    """
+
+    def __init__(self, providers, refresh_interval, max_age, retry_interval=30):
+        self.providers = providers
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def start(self):
+        for name in self.providers:
+            threading.Thread(target=self._refresh_forever, args=(name,), name="fx-" + name, daemon=True).start()
+        return self
+
+    def _refresh_forever(self, name):
+        while True:
+            interval = self.refresh_interval.get(name, 300)
+            if not self.refresh(name):
+                interval = min(interval, self.retry_interval)
+            time.sleep(interval)
+
+    def refresh(self, name):
+        try:
+            err_flag, fx = self.providers[name]()
+        except:
+            logger.exception("Error while refreshing FX provider %s", name)
+            err_flag, fx = True, None
+        if err_flag:
+            return False
+        with self.lock:
+            self.entries[name] = (fx, time.time())
+        for symbol, rate in fx.items():
+            price_history.record("fx-" + name, symbol, rate)
+        self.ready.set()
+        return True
+
+    def get(self, name):
+        """Returns (fx, age in seconds) of a provider, or (None, None) before its first refresh."""
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None:
+            return None, None
+        fx, fetched_at = entry
+        return fx, time.time() - fetched_at
+
+    def snapshot(self):
+        """Returns (err_flag, fx) per provider in the shape combine_fx expects."""
+        results = []
+        for name in self.providers:
+            fx, age = self.get(name)
+            if fx is None:
+                results.append((True, None))
+                continue
+            METRIC_FX_AGE.labels(name).set(age)
+            if age > self.max_age.get(name, 1800):
+                logger.warning("FX rates from %s are stale (%ds old)", name, age)
+                results.append((True, None))
+            else:
+                results.append((False, fx))
+        return results
+
+
+fx_api_collection = {
+    "alphavantage": get_fx_rate,
+    "free_api": get_fx_rate_free,
+    "band": get_fx_rate_from_band
+}
+
+
 # combine all fx rate from sources
 def combine_fx(res_fxs):
     fx_combined = {
@@ -512,8 +1303,7 @@ def combine_fx(res_fxs):
         "USDTHB":[],
     }
     all_fx_err_flag = True
-    for res_fx in res_fxs:
-        err_flag, fx = res_fx.result()
+    for err_flag, fx in res_fxs:
         all_fx_err_flag = all_fx_err_flag and err_flag
         if not err_flag:
             for key in fx_combined:
@@ -527,220 +1317,501 @@ def combine_fx(res_fxs):
             all_fx_err_flag = True
     return all_fx_err_flag, fx_combined
 
-# get binance luna usdt price
-def get_binance_luna_price():
-    err_flag = False
-    try:
-        client = binance_client
-        if client is None:
-            client = binance.client.Client(binance_key, binance_secret)
-        avg_price = client.get_avg_price(symbol='LUNAUSDT')
-        s1 = json.dumps(avg_price)
-        response_dict = json.loads(s1)
-        luna_price = response_dict["price"]
-        logger.exception(luna_price)
-    except:
-        logger.exception("Error in get_binance_luna_price")
-        err_flag = True
-        luna_price = None
+class TradeWindow:
+    """Deduplicated trades of one exchange in array-backed ring buffers.
+
+    Running price*volume and volume sums are kept for every window length,
+    so ingesting a poll costs O(new trades) and reading a VWAP is O(1)
+    amortized.
+    """
+
+    def __init__(self, windows, capacity):
+        self.windows = sorted(set(windows))
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.prices = array('d', [0.0]) * capacity
+        self.volumes = array('d', [0.0]) * capacity
+        # absolute trade indexes; the slot of trade i is i % capacity
+        self.head = 0
+        self.tails = {window: 0 for window in self.windows}
+        self.sum_price_volume = {window: 0.0 for window in self.windows}
+        self.sum_volume = {window: 0.0 for window in self.windows}
+        self.last_timestamp = 0.0
+        self.last_keys = set()
+
+    def ingest(self, trades):
+        """Adds the unseen trades of a newest-first iterable of (key, timestamp, price, volume).
+
+        Returns the added trades, oldest first.
+        """
+        new_trades = []
+        for key, timestamp, price, volume in trades:
+            if timestamp < self.last_timestamp:
+                break
+            if timestamp == self.last_timestamp and key in self.last_keys:
+                continue
+            new_trades.append((key, timestamp, price, volume))
+
+        new_trades.reverse()
+        for key, timestamp, price, volume in new_trades:
+            if timestamp > self.last_timestamp:
+                self.last_timestamp = timestamp
+                self.last_keys = set()
+            self.last_keys.add(key)
+            self._append(timestamp, price, volume)
+        return new_trades
+
+    def _append(self, timestamp, price, volume):
+        if self.head - self.capacity >= 0:
+            # the slot is reused, drop the overwritten trade from every window still holding it
+            for window in self.windows:
+                if self.tails[window] <= self.head - self.capacity:
+                    self._evict(window)
+        slot = self.head % self.capacity
+        self.timestamps[slot] = timestamp
+        self.prices[slot] = price
+        self.volumes[slot] = volume
+        self.head += 1
+        for window in self.windows:
+            self.sum_price_volume[window] += price * volume
+            self.sum_volume[window] += volume
+
+    def _evict(self, window):
+        slot = self.tails[window] % self.capacity
+        self.sum_price_volume[window] -= self.prices[slot] * self.volumes[slot]
+        self.sum_volume[window] -= self.volumes[slot]
+        self.tails[window] += 1
+        if self.tails[window] == self.head:
+            # empty window, reset the sums so float error cannot accumulate
+            self.sum_price_volume[window] = 0.0
+            self.sum_volume[window] = 0.0
+
+    def _expire(self, window, now):
+        cutoff = now - window
+        while self.tails[window] < self.head and self.timestamps[self.tails[window] % self.capacity] <= cutoff:
+            self._evict(window)
+
+    def vwap(self, window, now=None):
+        """Returns the VWAP of the trailing window (seconds), or None without trades."""
+        self._expire(window, time.time() if now is None else now)
+        if self.sum_volume[window] <= 0:
+            return None
+        return self.sum_price_volume[window] / self.sum_volume[window]
+
+
+class PriceSeries:
+    """The last capacity samples of one price series in array-backed ring buffers."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        # absolute sample index; the slot of sample i is i % capacity
+        self.head = 0
+
+    def __len__(self):
+        return min(self.head, self.capacity)
+
+    def append(self, timestamp, value):
+        slot = self.head % self.capacity
+        self.timestamps[slot] = timestamp
+        self.values[slot] = value
+        self.head += 1
+
+    def _newest_first(self):
+        for i in range(self.head - 1, self.head - len(self) - 1, -1):
+            slot = i % self.capacity
+            yield self.timestamps[slot], self.values[slot]
+
+    def last(self, n=None):
+        """The newest n (timestamp, value) samples, oldest first."""
+        samples = list(itertools.islice(self._newest_first(), n))
+        samples.reverse()
+        return samples
+
+    def twap(self, window, now=None):
+        """Time-weighted average over the trailing window (seconds), each sample holding until the next."""
+        now = time.time() if now is None else now
+        start = now - window
+        total = 0.0
+        end = now
+        for timestamp, value in self._newest_first():
+            begin = min(max(timestamp, start), end)
+            total += value * (end - begin)
+            end = begin
+            if timestamp <= start:
+                break
+        if now - end <= 0:
+            return None
+        return total / (now - end)
+
+    def volatility(self, window, now=None):
+        """Standard deviation of the log returns between samples of the trailing window, or None below 3 samples."""
+        now = time.time() if now is None else now
+        values = [value for timestamp, value in self._newest_first() if timestamp > now - window]
+        if len(values) < 3:
+            return None
+        return statistics.pstdev([math.log(newer / older) for newer, older in zip(values, values[1:])])
+
+
+# archive record: timestamp, series id, value
+PRICE_ARCHIVE_RECORD = struct.Struct("<dId")
+PRICE_ARCHIVE_DTYPE = np.dtype([("timestamp", "<f8"), ("series", "<u4"), ("value", "<f8")])
+
+
+class PriceHistory:
+    """Recent prices per (source, denom), archived to an append-only binary file.
+
+    record() only touches memory; flush() writes what was recorded since with
+    a single write, off the critical path of the round. Series id n of the
+    archive is line n of the ".series" file next to it.
+    """
+
+    def __init__(self, capacity, archive_path=""):
+        self.capacity = capacity
+        self.archive_path = archive_path
+        self.series = {}
+        self.series_ids = {}
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.archive = None
+
+    def start(self):
+        """Opens the archive for appending (nothing is archived before)."""
+        if self.archive_path:
+            self._open_archive()
+        return self
+
+    def _open_archive(self):
+        names_path = self.archive_path + ".series"
+        if os.path.exists(names_path):
+            with open(names_path) as names:
+                for line in names:
+                    if line.endswith("\n"):
+                        self.series_ids[line[:-1]] = len(self.series_ids)
+        self.names_file = open(names_path, "a")
+        self.archive = open(self.archive_path, "ab")
+        torn = self.archive.tell() % PRICE_ARCHIVE_RECORD.size
+        if torn:
+            logger.warning("Dropping a torn record at the end of %s", self.archive_path)
+            self.archive.truncate(self.archive.tell() - torn)
+            self.archive.seek(0, os.SEEK_END)
+
+    def _series_id(self, name):
+        series_id = self.series_ids.get(name)
+        if series_id is None:
+            series_id = self.series_ids[name] = len(self.series_ids)
+            self.names_file.write(name + "\n")
+            self.names_file.flush()
+        return series_id
+
+    def record(self, source, denom, value, timestamp=None):
+        """Adds a price sample; missing, zero (abstain) and non-finite prices are skipped."""
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        if not 0 < value < float("inf"):
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            series = self.series.get((source, denom))
+            if series is None:
+                series = self.series[(source, denom)] = PriceSeries(self.capacity)
+            series.append(timestamp, value)
+            if self.archive is not None:
+                self.pending += PRICE_ARCHIVE_RECORD.pack(
+                    timestamp, self._series_id(source + "/" + denom), value)
+
+    def get(self, source, denom):
+        """The PriceSeries of (source, denom), or None before its first sample."""
+        return self.series.get((source, denom))
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            try:
+                self.archive.write(self.pending)
+                self.archive.flush()
+            except:
+                logger.exception("Error while writing the price archive")
+            self.pending = bytearray()
 
-    return err_flag, luna_price
 
-# get coinone luna krw price
-@time_request('coinone')
-def get_coinone_luna_price():
-    err_flag = False
-    try:
-        if vwma_period > 1:
-            url = "https://api.coinone.co.kr/trades/?currency=luna"
-            luna_result = session.get(url, timeout=http_timeout).json()["completeOrders"]
-            hist_price = []
-            sum_price_volume = 0
-            sum_volume = 0
-            now_time = float(time.time())
-
-            for row in luna_result:
-                if now_time - float(row['timestamp']) < vwma_period:
-                    sum_price_volume += float(row["price"]) * float(row["qty"])
-                    sum_volume += float(row["qty"])
-                else:
-                    break
+def load_price_archive(path):
+    """Maps a price archive read-only; returns (series names by id, records as a numpy structured array)."""
+    with open(path + ".series") as names_file:
+        names = [line[:-1] for line in names_file if line.endswith("\n")]
+    count = os.path.getsize(path) // PRICE_ARCHIVE_RECORD.size
+    if count == 0:
+        return names, np.zeros(0, dtype=PRICE_ARCHIVE_DTYPE)
+    return names, np.memmap(path, dtype=PRICE_ARCHIVE_DTYPE, mode="r", shape=(count,))
 
-            askprice = sum_price_volume / sum_volume
-            bidprice = sum_price_volume / sum_volume
-        else:
-            url = "https://api.coinone.co.kr/orderbook/?currency=luna&format=json"
-            luna_result = session.get(url, timeout=http_timeout).json()
-            askprice = float(luna_result["ask"][0]["price"])
-            bidprice = float(luna_result["bid"][0]["price"])
-        midprice = (askprice + bidprice) / 2.0
-        luna_price = {
-            "base_currency": "ukrw",
-            "exchange": "coinone",
-            "askprice": askprice,
-            "bidprice": bidprice,
-            "midprice": midprice
-        }
-        luna_base = "USDKRW"
-        luna_midprice_krw = float(luna_price["midprice"])
-    except:
-        METRIC_OUTBOUND_ERROR.labels('coinone').inc()
-        logger.exception("Error in get_coinone_luna_price")
-        err_flag = True
-        luna_price = None
-        luna_base = None
-        luna_midprice_krw = None
 
-    return err_flag, luna_price, luna_base, luna_midprice_krw
+price_history = PriceHistory(price_history_capacity, price_archive_file)
 
 
-# get bithumb luna krw price
-@time_request('bithumb')
-def get_bithumb_luna_price():
-    err_flag = False
-    try:
-        # get luna/krw
-        url = "https://api.bithumb.com/public/orderbook/luna_krw"
-        luna_result = session.get(url, timeout=http_timeout).json()["data"]
-        askprice = float(luna_result["asks"][0]["price"])
-        bidprice = float(luna_result["bids"][0]["price"])
-        midprice = (askprice + bidprice) / 2.0
-        luna_price = {
-            "base_currency": "ukrw",
-            "exchange": "bithumb",
-            "askprice": askprice,
-            "bidprice": bidprice,
-            "midprice": midprice
-        }
-        luna_base = "USDKRW"
-        luna_midprice_krw = float(luna_price["midprice"])
-    except:
-        METRIC_OUTBOUND_ERROR.labels('bithumb').inc()
-        logger.exception("Error in get_bithumb_luna_price")
-        err_flag = True
-        luna_price = None
-        luna_base = None
-        luna_midprice_krw = None
+KST = datetime.timezone(datetime.timedelta(hours=9))
 
-    return err_flag, luna_price, luna_base, luna_midprice_krw
 
+# trade parsers yield (key, timestamp, price, volume) newest first and convert lazily,
+# so rows that were already ingested are never parsed again
+def coinone_trades(result):
+    for row in result["completeOrders"]:
+        timestamp = float(row["timestamp"])
+        yield (row.get("id") or (row["timestamp"], row["price"], row["qty"]),
+               timestamp, float(row["price"]), float(row["qty"]))
 
-# get gopax luna krw price
-@time_request('gopax')
-def get_gopax_luna_price():
-    err_flag = False
-    try:
-        # get luna/krw
-        url = "https://api.gopax.co.kr/trading-pairs/LUNA-KRW/book"
-        luna_result = session.get(url, timeout=http_timeout).json()
-        askprice = float(luna_result["ask"][0][1])
-        bidprice = float(luna_result["bid"][0][1])
-        midprice = (askprice + bidprice) / 2.0
-        luna_price = {
-            "base_currency": "ukrw",
-            "exchange": "gopax",
-            "askprice": askprice,
-            "bidprice": bidprice,
-            "midprice": midprice
-        }
-        luna_base = "USDKRW"
-        luna_midprice_krw = float(luna_price["midprice"])
-    except:
-        METRIC_OUTBOUND_ERROR.labels('gopax').inc()
-        logger.exception("Error in get_gopax_luna_price")
-        err_flag = True
 
-        # gopax_share is set to zero if an error occurs
-        luna_price = 0
-        luna_base = 0
-        luna_midprice_krw = 0
+def bithumb_trades(result):
+    for row in reversed(result["data"]):
+        timestamp = datetime.datetime.strptime(
+            row["transaction_date"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=KST).timestamp()
+        yield ((row["transaction_date"], row["price"], row["units_traded"], row["type"]),
+               timestamp, float(row["price"]), float(row["units_traded"]))
 
-    return err_flag, luna_price, luna_base, luna_midprice_krw
 
+def gopax_trades(result):
+    for row in result:
+        yield row["id"], float(row["date"]), float(row["price"]), float(row["amount"])
 
-# get gdac luna krw price
-@time_request('gdac')
-def get_gdac_luna_price():
-    err_flag = False
-    try:
-        # get luna/krw
-        url = "https://partner.gdac.com/v0.4/public/orderbook?pair=LUNA%2FKRW"
-        luna_result = session.get(url, timeout=http_timeout).json()
-        askprice = float(luna_result["ask"][0]["price"])
-        bidprice = float(luna_result["bid"][0]["price"])
-        midprice = (askprice + bidprice) / 2.0
-        luna_price = {
-            "base_currency": "ukrw",
-            "exchange": "gdac",
-            "askprice": askprice,
-            "bidprice": bidprice,
-            "midprice": midprice
-        }
-        luna_base = "USDKRW"
-        luna_midprice_krw = float(luna_price["midprice"])
-    except:
-        METRIC_OUTBOUND_ERROR.labels('gdax').inc()
-        logger.exception("Error in get_gdac_luna_price")
-        err_flag = True
 
-        # gdac_share is set to zero if an error occurs
-        luna_price = 0
-        luna_base = 0
-        luna_midprice_krw = 0
+trade_feeds = {
+    "coinone": ("https://api.coinone.co.kr/trades/?currency=luna", coinone_trades),
+    "bithumb": ("https://api.bithumb.com/public/transaction_history/LUNA_KRW", bithumb_trades),
+    "gopax": ("https://api.gopax.co.kr/trading-pairs/LUNA-KRW/trades", gopax_trades),
+}
 
-    return err_flag, luna_price, luna_base, luna_midprice_krw
+trade_windows = {
+    exchange: TradeWindow(vwap_windows + [vwma_period], vwap_capacity) for exchange in trade_feeds
+}
 
 
-# get band luna krw price
-@time_request('band-luna')
-def get_band_luna_price():
-    binance, coinone, bithumb, gdac, gopax = None, None, None, None, None
-    try:
-        oracle_script_id, multiplier, min_count, ask_count = [int(param, 10) for param in band_luna_price_params.split(",")]
-        bandcli = Client(band_endpoint)
-        schema = bandcli.get_oracle_script(oracle_script_id).schema
-        obi = PyObi(schema)
-        result = obi.decode_output(
-            bandcli.get_latest_request(
-                oracle_script_id,
-                obi.encode_input({
-                    "multiplier": multiplier
-                }),
-                min_count,
-                ask_count
-            ).result.response_packet_data.result
-        )
-        abms = []
-        exchanges = ["binance", "huobipro", "coinone", "bithumb", "gdac", "gopax"]
-        for (order_book,ex) in zip(result['prices'], exchanges):
-            abm = None
-            if order_book['ask'] > 0 and order_book['bid'] > 0 and order_book['mid'] > 0:
-                luna_price = {
-                    "base_currency": "ukrw",
-                    "exchange": f"band_{ex}",
-                    "askprice": order_book['ask']/multiplier,
-                    "bidprice": order_book['bid']/multiplier,
-                    "midprice": order_book['mid']/multiplier
-                }
-                luna_base = "USDKRW"
-                luna_midprice_krw = order_book['mid']/multiplier
-                abm = (luna_price, luna_base, luna_midprice_krw)
-            abms.append(abm)
-        binance, _, coinone, bithumb, gdac, gopax = abms
-    except:
-        METRIC_OUTBOUND_ERROR.labels('band-luna').inc()
-        logger.exception("Error in get_band_luna_price")
+async def fetch_vwap_price(exchange):
+    """Ingests the new trades of an exchange and returns its VWAP over VWMA_PERIOD."""
+    url, parse_trades = trade_feeds[exchange]
+    trade_window = trade_windows[exchange]
+    async with async_runtime.session.get(outbound_url(url)) as response:
+        new_trades = trade_window.ingest(parse_trades(await response.json(content_type=None)))
+    # archived trade by trade so a backtest can rebuild the VWAP of any period;
+    # "<exchange>-trades" and "<exchange>-volume" are recorded in pairs
+    base_currency = exchange_adapters[exchange].base_currency
+    for key, timestamp, price, volume in new_trades:
+        if price > 0 and volume > 0:
+            price_history.record(exchange + "-trades", base_currency, price, timestamp)
+            price_history.record(exchange + "-volume", base_currency, volume, timestamp)
+    now = time.time()
+    for window in trade_window.windows:
+        window_vwap = trade_window.vwap(window, now)
+        if window_vwap is not None:
+            METRIC_EXCHANGE_VWAP.labels(exchange, str(window)).set(window_vwap)
+    luna_vwap = trade_window.vwap(vwma_period, now)
+    if luna_vwap is None:
+        raise ValueError("no {} trades in the last {}s".format(exchange, vwma_period))
+    return luna_vwap
+
+
+# uniform LUNA quote of one venue, prices in base_currency
+Quote = collections.namedtuple("Quote", ["exchange", "base_currency", "askprice", "bidprice", "midprice"])
+
+# url: order book endpoint, parse_book: json -> (askprice, bidprice), weight: share in the LUNA/KRW average
+ExchangeAdapter = collections.namedtuple("ExchangeAdapter", ["name", "url", "parse_book", "base_currency", "weight"])
+
+exchange_adapters = collections.OrderedDict()
+
+
+def register_exchange(name, url, parse_book, base_currency, weight):
+    """Adds a venue to every round; trade_feeds entries of the same name switch it to VWAP."""
+    exchange_adapters[name] = ExchangeAdapter(name, url, parse_book, base_currency, weight)
+
+
+def coinone_book(result):
+    return float(result["ask"][0]["price"]), float(result["bid"][0]["price"])
+
 
-    return binance, coinone, bithumb, gdac, gopax
+def bithumb_book(result):
+    return float(result["data"]["asks"][0]["price"]), float(result["data"]["bids"][0]["price"])
+
+
+def gopax_book(result):
+    return float(result["ask"][0][1]), float(result["bid"][0][1])
+
+
+def gdac_book(result):
+    return float(result["ask"][0]["price"]), float(result["bid"][0]["price"])
+
+
+def binance_avg_price(result):
+    avg_price = float(result["price"])
+    return avg_price, avg_price
+
+
+def binance_book(result):
+    return float(result["askPrice"]), float(result["bidPrice"])
+
+
+register_exchange("coinone", "https://api.coinone.co.kr/orderbook/?currency=luna&format=json",
+                  coinone_book, "ukrw", coinone_share_default)
+register_exchange("bithumb", "https://api.bithumb.com/public/orderbook/luna_krw",
+                  bithumb_book, "ukrw", bithumb_share_default)
+register_exchange("gopax", "https://api.gopax.co.kr/trading-pairs/LUNA-KRW/book",
+                  gopax_book, "ukrw", gopax_share_default)
+register_exchange("gdac", "https://partner.gdac.com/v0.4/public/orderbook?pair=LUNA%2FKRW",
+                  gdac_book, "ukrw", gdac_share_default)
+register_exchange("binance", "https://api.binance.com/api/v3/avgPrice?symbol=LUNAUSDT",
+                  binance_avg_price, "uusd", 0)
+
+# the venue whose base currency the LUNA/KRW aggregate is in (replaced by Band when the swap price is missing)
+reference_exchange = "coinone"
+# the LUNA/USD quote every denom is derived from
+usd_reference_exchange = "binance"
+
+
+# best ask/bid of a streamed venue; sequence orders updates, updated_at is local time
+TopOfBook = collections.namedtuple("TopOfBook", ["askprice", "bidprice", "sequence", "updated_at"])
+
+
+class BookStream:
+    """Live top of book of one venue, kept in memory by a background feed.
+
+    Feeds call update(); an update whose sequence is not newer than the book
+    is dropped. quote() is a memory read and returns None once the book is
+    older than max_age, so the round falls back to a REST fetch.
+    """
+
+    def __init__(self, adapter, max_age):
+        self.adapter = adapter
+        self.max_age = max_age
+        self.book = None
+
+    def update(self, askprice, bidprice, sequence):
+        if self.book is not None and sequence <= self.book.sequence:
+            return
+        self.book = TopOfBook(askprice, bidprice, sequence, time.time())
+        METRIC_BOOK_UPDATES.labels(self.adapter.name).inc()
+
+    def quote(self):
+        book = self.book
+        if book is None:
+            return None
+        age = time.time() - book.updated_at
+        METRIC_BOOK_AGE.labels(self.adapter.name).set(age)
+        if age > self.max_age:
+            return None
+        return Quote(self.adapter.name, self.adapter.base_currency, book.askprice, book.bidprice,
+                     (book.askprice + book.bidprice) / 2.0)
+
+
+async def feed_forever(stream, connect, max_backoff=30):
+    """Runs a feed coroutine, reconnecting with exponential backoff."""
+    backoff = 1
+    while True:
+        try:
+            await connect(stream)
+            backoff = 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            METRIC_OUTBOUND_ERROR.labels(stream.adapter.name + "-stream").inc()
+            logger.warning("%s book feed error", stream.adapter.name, exc_info=True)
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, max_backoff)
+
+
+async def poll_book_feed(stream):
+    """Long-polls the REST order book over the pooled keep-alive connection."""
+    sequence = 0
+    while True:
+        async with async_runtime.session.get(outbound_url(stream.adapter.url)) as response:
+            askprice, bidprice = stream.adapter.parse_book(await response.json(content_type=None))
+        sequence += 1
+        stream.update(askprice, bidprice, sequence)
+        await asyncio.sleep(stream_poll_interval)
+
+
+async def binance_book_feed(stream):
+    """Follows the Binance bookTicker stream (best bid/ask, ordered by update id u)."""
+    async with async_runtime.session.ws_connect(outbound_url(binance_stream_url), heartbeat=30) as ws:
+        logger.info("Streaming binance book from %s", binance_stream_url)
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            ticker = json.loads(msg.data)
+            stream.update(float(ticker["a"]), float(ticker["b"]), int(ticker["u"]))
+
+
+# venues with a push feed; every other streamed venue is long-polled
+book_feeds = {
+    "binance": binance_book_feed
+}
+
+# (url, parse_book) a streamed venue falls back to when its REST adapter quotes something else, so the
+# price keeps the stream's meaning: a streamed binance is the bookTicker mid, not the 5-minute avgPrice
+stream_rest_books = {
+    "binance": ("https://api.binance.com/api/v3/ticker/bookTicker?symbol=LUNAUSDT", binance_book)
+}
+
+book_streams = {}
+
+
+def start_book_streams(names):
+    for name in names:
+        if name not in exchange_adapters:
+            logger.error("Cannot stream %s: no such exchange", name)
+            continue
+        book_streams[name] = BookStream(exchange_adapters[name], stream_max_age)
+        async_runtime.submit(feed_forever(book_streams[name], book_feeds.get(name, poll_book_feed)))
+
+
+async def fetch_quote(adapter):
+    """Returns a Quote for one adapter, or None on any error.
+
+    A fresh streamed book is used as is; VWAP venues keep using their trades.
+    """
+    stream = book_streams.get(adapter.name)
+    if stream is not None and not (vwma_period > 1 and adapter.name in trade_feeds):
+        quote = stream.quote()
+        if quote is not None:
+            return quote
+    with METRIC_OUTBOUND_LATENCY.labels(adapter.name).time():
+        try:
+            if vwma_period > 1 and adapter.name in trade_feeds:
+                askprice = bidprice = await fetch_vwap_price(adapter.name)
+            else:
+                url, parse_book = adapter.url, adapter.parse_book
+                if stream is not None:
+                    url, parse_book = stream_rest_books.get(adapter.name, (url, parse_book))
+                async with async_runtime.session.get(outbound_url(url)) as response:
+                    askprice, bidprice = parse_book(await response.json(content_type=None))
+            return Quote(adapter.name, adapter.base_currency, askprice, bidprice, (askprice + bidprice) / 2.0)
+        except asyncio.CancelledError:
+            raise
+        except:
+            METRIC_OUTBOUND_ERROR.labels(adapter.name).inc()
+            logger.exception("Error while fetching %s luna price", adapter.name)
+            return None
+
+
+# get band luna krw price
+async def fetch_band_luna_price():
+    """Returns the Band-reported Quote of each exchange (None where Band has no price)."""
+    with METRIC_OUTBOUND_LATENCY.labels('band-luna').time():
+        try:
+            return await band_data_source.luna_prices(band_luna_price_params)
+        except asyncio.CancelledError:
+            raise
+        except:
+            METRIC_OUTBOUND_ERROR.labels('band-luna').inc()
+            logger.exception("Error in fetch_band_luna_price")
+            return {}
 
 # get swap price
 @time_request('lcd')
-def get_swap_price():
+def get_swap_price(pool):
     err_flag = False
     try:
-        result = session.get(
-            "{}/oracle/denoms/exchange_rates".format(lcd_address),
-            timeout=http_timeout).json()
+        result = pool.get("/oracle/denoms/exchange_rates")
     except:
         METRIC_OUTBOUND_ERROR.labels('lcd').inc()
         logger.exception("Error in get_swap_price")
@@ -750,6 +1821,138 @@ def get_swap_price():
     return err_flag, result
 
 
+class FetchCoordinator:
+    """Runs the fetches of a round under one deadline.
+
+    A source still pending after the hedge percentile of its recent latencies
+    gets a duplicate request and the first useful answer wins. At the deadline
+    stragglers are cancelled and the round goes ahead with what has arrived;
+    missing sources get their default, which the usual fallbacks then handle.
+    """
+
+    def __init__(self, runtime, hedge_percentile, history=50, min_samples=10):
+        self.runtime = runtime
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=history))
+
+    def hedge_delay(self, name):
+        samples = self.latencies[name]
+        if self.hedge_percentile <= 0 or len(samples) < self.min_samples:
+            return None
+        return float(np.percentile(samples, self.hedge_percentile))
+
+    async def _hedged(self, name, fetch):
+        """Returns the first non-None result of fetch(), hedging it once if it is slow."""
+        started = {asyncio.ensure_future(fetch()): time.time()}
+        delay = self.hedge_delay(name)
+        try:
+            while True:
+                pending = [attempt for attempt in started if not attempt.done()]
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None and attempt.result() is not None:
+                        self.latencies[name].append(time.time() - started[attempt])
+                        return attempt.result()
+                if not done and len(started) == 1:
+                    METRIC_FETCH_HEDGED.labels(name).inc()
+                    logger.info("%s slower than %.3fs, sending a hedged request", name, delay)
+                    started[asyncio.ensure_future(fetch())] = time.time()
+                    delay = None
+        finally:
+            for attempt in started:
+                attempt.cancel()
+        for attempt in started:
+            if attempt.exception() is not None:
+                raise attempt.exception()
+        return None
+
+    def gather(self, fetches, deadline):
+        """Runs {name: (fetch, default)} until all are done or deadline passes and returns {name: result}."""
+        async def run():
+            tasks = {name: asyncio.ensure_future(self._hedged(name, fetch)) for name, (fetch, _) in fetches.items()}
+            await asyncio.wait(list(tasks.values()), timeout=max(deadline - time.time(), 0))
+            results = {}
+            for name, task in tasks.items():
+                results[name] = fetches[name][1]
+                if not task.done():
+                    task.cancel()
+                    METRIC_FETCH_CANCELLED.labels(name).inc()
+                    logger.warning("%s missed the fetch deadline, going ahead without it", name)
+                elif task.exception() is not None:
+                    logger.error("Error while fetching %s: %r", name, task.exception())
+                elif task.result() is not None:
+                    results[name] = task.result()
+            return results
+        return self.runtime.run(run())
+
+
+fetch_coordinator = FetchCoordinator(async_runtime, fetch_hedge_percentile)
+
+
+def market_fetches():
+    """The chain-independent fetches of a round as {name: (coroutine function, default on failure)}."""
+    fetches = collections.OrderedDict()
+    fetches["band-luna"] = (fetch_band_luna_price, {})
+    for adapter in exchange_adapters.values():
+        fetches[adapter.name] = (functools.partial(fetch_quote, adapter), None)
+    return fetches
+
+
+class MarketCache:
+    """Exchange and Band quotes of the last fetch, reused by the other chains for max_age seconds.
+
+    Every chain uses a snapshot at most once, so each round of a chain sees
+    new quotes. The lock is held through the fetch, so a chain arriving
+    meanwhile waits for the result instead of asking the exchanges again.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.market = None
+        self.fetched_at = 0
+        self.used_by = set()
+
+    def fetch(self, chain, deadline):
+        """Returns (swap price result of chain, market quotes) fetched until deadline."""
+        with self.lock:
+            fetches = collections.OrderedDict()
+            fetches["lcd-swap"] = (lambda: async_runtime.loop.run_in_executor(None, get_swap_price, chain.lcd_pool),
+                                   (True, {"result": []}))
+            fresh = self.market is not None and chain.chain_id not in self.used_by and (
+                time.time() - self.fetched_at < self.max_age)
+            if not fresh:
+                fetches.update(market_fetches())
+            fetched = fetch_coordinator.gather(fetches, deadline)
+            if not fresh:
+                self.market = {name: fetched[name] for name in market_fetches()}
+                self.fetched_at = time.time()
+                self.used_by = set()
+                self._record(self.market)
+            self.used_by.add(chain.chain_id)
+            return fetched["lcd-swap"], self.market
+
+    def _record(self, market):
+        for name in exchange_adapters:
+            if market[name] is not None:
+                price_history.record(name, market[name].base_currency, market[name].midprice, self.fetched_at)
+                if not (vwma_period > 1 and name in trade_feeds):
+                    # the order book, for replaying the spread filter
+                    price_history.record(name + "-ask", market[name].base_currency, market[name].askprice,
+                                         self.fetched_at)
+                    price_history.record(name + "-bid", market[name].base_currency, market[name].bidprice,
+                                         self.fetched_at)
+        for name, quote in market["band-luna"].items():
+            if quote is not None:
+                price_history.record("band-" + name, quote.base_currency, quote.midprice, self.fetched_at)
+
+
+market_cache = MarketCache(market_max_age)
+
+
 def get_hash(salt, price, denom, validator):
     m = hashlib.sha256()
     m.update("{}:{}:{}:{}".format(salt, price, denom, validator).encode('utf-8'))
@@ -762,487 +1965,1515 @@ def get_salt(string):
     return str(hashlib.sha256(b_string).hexdigest())[:4]
 
 
-def broadcast_messages(messages):
-    tx_json = {
+# amino binary encoding, just enough for oracle StdTx
+def amino_prefix(name):
+    digest = hashlib.sha256(name.encode()).digest().lstrip(b'\x00')[3:].lstrip(b'\x00')
+    return digest[:4]
+
+
+def amino_uvarint(number):
+    result = bytearray()
+    while True:
+        byte = number & 0x7f
+        number >>= 7
+        if number:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def amino_varint_field(field_number, value):
+    if not value:
+        return b''
+    return amino_uvarint(field_number << 3) + amino_uvarint(value)
+
+
+def amino_bytes_field(field_number, value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if not value:
+        return b''
+    return amino_uvarint(field_number << 3 | 2) + amino_uvarint(len(value)) + value
+
+
+def amino_address(address):
+    import bech32
+    _, data = bech32.bech32_decode(address)
+    return bytes(bech32.convertbits(data, 5, 8, False))
+
+
+def amino_dec(dec_string):
+    """sdk.Dec is amino-encoded as the string of its 10^18-scaled integer."""
+    whole, _, frac = dec_string.partition(".")
+    return str(int(whole + frac.ljust(18, "0")[:18]))
+
+
+def amino_encode_msg(msg):
+    value = msg["value"]
+    if msg["type"] == "oracle/MsgExchangeRatePrevote":
+        body = (amino_bytes_field(1, bytes.fromhex(value["hash"])) +
+                amino_bytes_field(2, value["denom"]) +
+                amino_bytes_field(3, amino_address(value["feeder"])) +
+                amino_bytes_field(4, amino_address(value["validator"])))
+    elif msg["type"] == "oracle/MsgExchangeRateVote":
+        body = (amino_bytes_field(1, amino_dec(value["exchange_rate"])) +
+                amino_bytes_field(2, value["salt"]) +
+                amino_bytes_field(3, value["denom"]) +
+                amino_bytes_field(4, amino_address(value["feeder"])) +
+                amino_bytes_field(5, amino_address(value["validator"])))
+    else:
+        raise ValueError("cannot amino-encode {}".format(msg["type"]))
+    return amino_prefix(msg["type"]) + body
+
+
+def amino_encode_tx(tx_value):
+    fee = tx_value["fee"]
+    fee_bytes = b''.join(
+        amino_bytes_field(1, amino_bytes_field(1, coin["denom"]) + amino_bytes_field(2, coin["amount"]))
+        for coin in fee["amount"]) + amino_varint_field(2, int(fee["gas"]))
+    signature_bytes = b''
+    for signature in tx_value["signatures"]:
+        pub_key_bytes = base64.b64decode(signature["pub_key"]["value"])
+        pub_key = amino_prefix(signature["pub_key"]["type"]) + amino_uvarint(len(pub_key_bytes)) + pub_key_bytes
+        signature_bytes += amino_bytes_field(3, amino_bytes_field(1, pub_key) + amino_bytes_field(
+            2, base64.b64decode(signature["signature"])))
+    return amino_prefix("core/StdTx") + (
+        b''.join(amino_bytes_field(1, amino_encode_msg(msg)) for msg in tx_value["msg"]) +
+        amino_bytes_field(2, fee_bytes) +
+        signature_bytes +
+        amino_bytes_field(4, tx_value["memo"]))
+
+
+def load_feeder_key(v):
+    import coincurve
+    if v.feeder_private_key:
+        return coincurve.PrivateKey(bytes.fromhex(v.feeder_private_key))
+    import bip32
+    import mnemonic
+    seed = mnemonic.Mnemonic("english").to_seed(v.feeder_mnemonic)
+    return coincurve.PrivateKey(bip32.BIP32.from_seed(seed).get_privkey_from_path(v.feeder_hd_path))
+
+
+@time_request('lcd')
+def get_account_info(address, pool):
+    result = pool.get("/auth/accounts/{}".format(address))["result"]["value"]
+    return int(result["account_number"]), int(result.get("sequence") or 0)
+
+
+def sign_tx(tx_json, account_number, sequence, v):
+    """Signs a StdTx in-process with the feeder key of v and returns the signed tx."""
+    if v.feeder_key is None:
+        v.feeder_key = load_feeder_key(v)
+    feeder_key = v.feeder_key
+    tx_value = tx_json["value"]
+    sign_doc = {
+        "account_number": str(account_number),
+        "chain_id": v.chain.chain_id,
+        "fee": tx_value["fee"],
+        "memo": tx_value["memo"],
+        "msgs": tx_value["msg"],
+        "sequence": str(sequence)
+    }
+    sign_bytes = json.dumps(sign_doc, sort_keys=True, separators=(",", ":")).encode('utf-8')
+    # compact r||s; libsecp256k1 always yields low-S signatures
+    signature = feeder_key.sign_recoverable(sign_bytes)[:64]
+    signed_value = dict(tx_value)
+    signed_value["signatures"] = [{
+        "pub_key": {
+            "type": "tendermint/PubKeySecp256k1",
+            "value": base64.b64encode(feeder_key.public_key.format(compressed=True)).decode()
+        },
+        "signature": base64.b64encode(signature).decode()
+    }]
+    return {"type": tx_json["type"], "value": signed_value}
+
+
+@time_request('rpc')
+def broadcast_tx_sync(tx_json_signed, pool):
+    """Posts an amino-encoded signed tx to Tendermint broadcast_tx_sync.
+
+    The result is shaped like `terracli tx broadcast --output json`.
+    """
+    tx_bytes = amino_encode_tx(tx_json_signed["value"])
+    result = pool.post("", json={
+        "jsonrpc": "2.0",
+        "id": "oracle",
+        "method": "broadcast_tx_sync",
+        "params": {"tx": base64.b64encode(tx_bytes).decode()}
+    })
+    if "error" in result:
+        raise RuntimeError("broadcast_tx_sync error: {}".format(result["error"]))
+    result = result["result"]
+    return {
+        "height": "0",
+        "txhash": result["hash"],
+        "code": result.get("code", 0),
+        "raw_log": result.get("log", "")
+    }
+
+
+def write_tx_file(tx_json, prefix):
+    """Writes a tx to a file of its own for terracli; the caller removes it."""
+    with tempfile.NamedTemporaryFile("w", dir=".", prefix=prefix, suffix=".json", delete=False) as tx_file:
+        json.dump(tx_json, tx_file)
+    return tx_file.name
+
+
+def sign_tx_terracli(tx_json, v, account_number=None, sequence=None):
+    """Signs with terracli, offline when the account number and sequence are given."""
+    logger.info("Signing...")
+    if account_number is not None:
+        account_args = ["--offline", "--account-number", str(account_number), "--sequence", str(sequence)]
+    else:
+        account_args = ["--node", v.chain.rpc_pool.best()]
+    # every validator and chain thread signs concurrently, so each tx gets its own file
+    tx_file = write_tx_file(tx_json, "tx_oracle_prevote_")
+    try:
+        cmd_output = subprocess.check_output([
+            terracli,
+            "tx", "sign", tx_file,
+            "--from", v.key_name,
+            "--chain-id", v.chain.chain_id,
+            "--home", v.home_cli,
+        ] + account_args, input=v.key_password + b'\n' + v.key_password + b'\n').decode()
+    finally:
+        os.remove(tx_file)
+
+    return json.loads(cmd_output)
+
+
+def broadcast_tx_terracli(tx_json_signed, v):
+    tx_file = write_tx_file(tx_json_signed, "tx_oracle_prevote_signed_")
+
+    logger.info("Broadcasting...")
+    try:
+        cmd_output = subprocess.check_output([
+            terracli,
+            "tx", "broadcast", tx_file,
+            "--output", "json",
+            "--from", v.key_name,
+            "--chain-id", v.chain.chain_id,
+            "--home", v.home_cli,
+            "--node", v.chain.rpc_pool.best(),
+        ], input=v.key_password + b'\n' + v.key_password + b'\n').decode()
+    finally:
+        os.remove(tx_file)
+
+    return json.loads(cmd_output)
+
+
+def static_fee():
+    return {
+        "amount": [
+            {
+                "denom": fee_denom,
+                "amount": fee_amount
+            }
+        ],
+        "gas": fee_gas
+    }
+
+
+def build_tx(messages, fee=None):
+    return {
         "type": "core/StdTx",
         "value": {
             "msg": messages,
-            "fee": {
-                "amount": [
-                    {
-                        "denom": fee_denom,
-                        "amount": fee_amount
-                    }
-                ],
-                "gas": fee_gas
-            },
+            "fee": fee or static_fee(),
             "signatures": [],
             "memo": ""
         }
     }
 
-    logger.info("Signing...")
-    json.dump(tx_json, open("tx_oracle_prevote.json", 'w'))
 
-    cmd_output = subprocess.check_output([
-        terracli,
-        "tx", "sign", "tx_oracle_prevote.json",
-        "--from", key_name,
-        "--chain-id", chain_id,
-        "--home", home_cli,
-        "--node", node
-    ], input=key_password + b'\n' + key_password + b'\n').decode()
+def message_shape(messages):
+    """The count of each message type, e.g. 15 prevotes or 15 votes + 15 prevotes."""
+    return tuple(sorted(collections.Counter(message["type"] for message in messages).items()))
+
+
+class FeeEstimator:
+    """Gas and fee of each tx shape, simulated with the LCD once per shape.
+
+    A shape without a simulation, or whose simulation is older than max_age,
+    is signed with the static FEE_GAS/FEE_AMOUNT while it is simulated in a
+    background thread, so no simulate call is made on the round's critical
+    path.
+    """
+
+    def __init__(self, gas_adjustment, gas_price, max_age):
+        self.gas_adjustment = gas_adjustment
+        self.gas_price = gas_price
+        self.max_age = max_age
+        # (chain id, shape) -> (gas, simulated at)
+        self.entries = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def fee(self, messages, chain):
+        key = (chain.chain_id, message_shape(messages))
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None or time.time() - entry[1] > self.max_age) and key not in self.pending:
+                self.pending.add(key)
+                threading.Thread(target=self._simulate, args=(key, messages, chain),
+                                 name="simulate-" + chain.chain_id, daemon=True).start()
+        if entry is None:
+            return static_fee()
+        gas = entry[0]
+        return {
+            "amount": [
+                {
+                    "denom": fee_denom,
+                    "amount": str(int(math.ceil(gas * self.gas_price)))
+                }
+            ],
+            "gas": str(gas)
+        }
 
-    tx_json_signed = json.loads(cmd_output)
-    json.dump(tx_json_signed, open("tx_oracle_prevote_signed.json", 'w'))
+    def forget(self, chain):
+        """Drops the simulations of chain, e.g. after a tx ran out of gas."""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == chain.chain_id]:
+                del self.entries[key]
 
-    logger.info("Broadcasting...")
-    cmd_output = subprocess.check_output([
-        terracli,
-        "tx", "broadcast", "tx_oracle_prevote_signed.json",
-        "--output", "json",
-        "--from", key_name,
-        "--chain-id", chain_id,
-        "--home", home_cli,
-        "--node", node,
-    ], input=key_password + b'\n' + key_password + b'\n').decode()
+    def _simulate(self, key, messages, chain):
+        try:
+            result = chain.lcd_pool.post("/txs/estimate_fee", json={
+                "tx": build_tx(messages)["value"],
+                "gas_prices": [{"denom": fee_denom, "amount": str(self.gas_price)}],
+                "gas_adjustment": str(self.gas_adjustment)
+            })["result"]
+            gas = int(result["gas"])
+            with self.lock:
+                self.entries[key] = (gas, time.time())
+            logger.info("Simulated %s on %s: %d gas", key[1], key[0], gas)
+        except:
+            METRIC_OUTBOUND_ERROR.labels('lcd').inc()
+            logger.exception("Error while simulating the gas of %s", key[1])
+        finally:
+            with self.lock:
+                self.pending.discard(key)
 
-    return json.loads(cmd_output)
 
+fee_estimator = FeeEstimator(fee_gas_adjustment, fee_gas_price, fee_simulate_max_age)
 
-def broadcast_prevote(hash):
-    logger.info("Prevoting...")
 
-    return broadcast_messages([
-        {
-            "type": "oracle/MsgExchangeRatePrevote",
-            "value": {
-                "hash": str(hash[denom]),
-                "denom": str(denom),
-                "feeder": feeder,
-                "validator": validator
-            }
-        } for denom in active
-    ])
+class AccountState:
+    """Account number and next sequence of a feeder account, kept locally.
 
+    Every signed tx takes the next sequence, so signing needs no node
+    round-trip. The LCD is queried on first use and again only after
+    invalidate(), i.e. once a broadcast was rejected for its sequence or its
+    outcome is unknown.
+    """
 
-def broadcast_all(vote_price, vote_salt, prevote_hash):
-    logger.info("Prevoting and voting...")
-    return broadcast_messages(
-        [
-            {
-                "type": "oracle/MsgExchangeRateVote",
-                "value": {
-                    "exchange_rate": str(vote_price[denom]),
-                    "salt": str(vote_salt[denom]),
-                    "denom": denom,
-                    "feeder": feeder,
-                    "validator": validator
-                }
-            } for denom in active
-        ] + [
-            {
-                "type": "oracle/MsgExchangeRatePrevote",
-                "value": {
-                    "hash": str(prevote_hash[denom]),
-                    "denom": str(denom),
-                    "feeder": feeder,
-                    "validator": validator
-                }
-            } for denom in active
-        ])
+    def __init__(self, address, lcd_pool):
+        self.address = address
+        self.lcd_pool = lcd_pool
+        self.account_number = None
+        self.sequence = None
+        self.lock = threading.Lock()
 
+    def reserve(self):
+        """Returns (account number, sequence) for the next tx."""
+        with self.lock:
+            if self.sequence is None:
+                METRIC_ACCOUNT_SYNCS.labels(self.address).inc()
+                self.account_number, self.sequence = get_account_info(self.address, self.lcd_pool)
+                logger.info("Synced account %d of %s at sequence %d", self.account_number, self.address, self.sequence)
+            sequence = self.sequence
+            self.sequence += 1
+            return self.account_number, sequence
 
-main_err_flag = True
-while main_err_flag:
-    latest_block_err_flag, latest_block_height, latest_block_time = get_latest_block()
-    if latest_block_err_flag == False:
-        height = latest_block_height
-        if height > last_height:
-            main_err_flag = False
-            last_height = height
-    time.sleep(1)
+    def invalidate(self):
+        with self.lock:
+            self.sequence = None
 
-last_prevoted_round = 0
-last_active = []
-last_hash = []
 
-while True:
+# AccountState of each (chain id, feeder); validators sharing a feeder share its sequence
+account_states = {}
 
-    main_err_flag = True
-    while main_err_flag:
-        latest_block_err_flag, latest_block_height, latest_block_time = get_latest_block()
-        if latest_block_err_flag == False:
-            height = latest_block_height
-            if height > last_height:
-                main_err_flag = False
-                last_height = height
-        time.sleep(1)
 
-    current_round = int(float(height - 1) / round_block_num)
-    next_height_round = int(float(height) / round_block_num)
+def account_state(chain, address):
+    key = (chain.chain_id, address)
+    if key not in account_states:
+        account_states[key] = AccountState(address, chain.lcd_pool)
+    return account_states[key]
 
-    num_blocks_till_next_round = (current_round + 1) * round_block_num - height
 
-    logger.debug("current_round: %d", current_round)
-    logger.debug("next_height_round: %d", next_height_round)
-    logger.debug("last_prevoted_round: %d", last_prevoted_round)
-    logger.debug("height: %d", height)
-    logger.debug("num_blocks_till_next_round: %d", num_blocks_till_next_round)
+def sequence_mismatch(broadcast_result):
+    """True when the chain rejected a broadcast tx for its account sequence."""
+    return int(broadcast_result.get("code", 0) or 0) != 0 and "sequence" in broadcast_result.get("raw_log", "")
 
-    if next_height_round > last_prevoted_round and (
-            num_blocks_till_next_round == 0 or num_blocks_till_next_round > 3):
 
-        # Get external data
-        all_err_flag = False
-        ts = time.time()
+def sign_messages(messages, v):
+    """Builds and signs a StdTx for v offline; the signed tx can be broadcast later with broadcast_signed.
 
-        fx_api_collection = {
-            "alphavantage": get_fx_rate,
-            "free_api": get_fx_rate_free,
-            "band": get_fx_rate_from_band
-        }
+    Without an account number and sequence (LCD down) terracli signs online.
+    """
+    tx_json = build_tx(messages, fee_estimator.fee(messages, v.chain) if fee_simulate else None)
+    if dry_run:
+        return tx_json
+    try:
+        account_number, sequence = v.account.reserve()
+    except:
+        METRIC_OUTBOUND_ERROR.labels('lcd').inc()
+        logger.exception("Error while syncing the account of %s", v.feeder)
+        account_number = sequence = None
+    try:
+        if v.signing_mode == "native" and account_number is not None:
+            try:
+                logger.info("Signing in-process...")
+                return sign_tx(tx_json, account_number, sequence, v)
+            except:
+                logger.exception("Native signing failed, falling back to terracli")
+        return sign_tx_terracli(tx_json, v, account_number, sequence)
+    except:
+        # the reserved sequence was not used
+        v.account.invalidate()
+        raise
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            res_swap = executor.submit(get_swap_price)
-            res_fxs = []
-            for fx_key in fx_api_option.split(","):
-                res_fxs.append( executor.submit(fx_api_collection[fx_key]))
-            #res_sdr = executor.submit(get_sdr_rate) sdr receive Option
-            res_coinone = executor.submit(get_coinone_luna_price)
-            res_bithumb = executor.submit(get_bithumb_luna_price)
-            res_gopax = executor.submit(get_gopax_luna_price)
-            res_gdac = executor.submit(get_gdac_luna_price)
-            res_band = executor.submit(get_band_luna_price)
-            res_binance = executor.submit(get_binance_luna_price)
-
-        def metrics_for_result(exchange, result):
-            if result:
-                METRIC_EXCHANGE_ASK_PRICE.labels(exchange, result['base_currency']).set(result['askprice'])
-                METRIC_EXCHANGE_BID_PRICE.labels(exchange, result['base_currency']).set(result['bidprice'])
-                METRIC_EXCHANGE_MID_PRICE.labels(exchange, result['base_currency']).set(result['midprice'])
 
-        metrics_for_result('coinone', res_coinone.result()[1])
-        metrics_for_result('bithumb', res_bithumb.result()[1])
-        metrics_for_result('gopax', res_gopax.result()[1])
-        metrics_for_result('res_gdac', res_gdac.result()[1])
+def broadcast_signed(tx_json_signed, v):
+    if v.signing_mode == "native":
+        try:
+            logger.info("Broadcasting...")
+            return broadcast_tx_sync(tx_json_signed, v.chain.rpc_pool)
+        except:
+            METRIC_OUTBOUND_ERROR.labels('rpc').inc()
+            logger.exception("RPC broadcast failed, falling back to terracli")
+    return broadcast_tx_terracli(tx_json_signed, v)
 
-        for rb in res_band.result():
-            if rb:
-                metrics_for_result(rb[0]['exchange'], rb[0])
 
-        # Get active set of denoms
-        swap_price_err_flag, swap_price = res_swap.result()
+def prevote_messages(prevote_hash, active, v):
+    return [
+        {
+            "type": "oracle/MsgExchangeRatePrevote",
+            "value": {
+                "hash": str(prevote_hash[denom]),
+                "denom": str(denom),
+                "feeder": v.feeder,
+                "validator": v.validator
+            }
+        } for denom in active
+    ]
 
-        if swap_price["result"] is None:
-            swap_price["result"] = []
 
-        if len(hardfix_active_set) == 0:
-            active = []
-            for denom in swap_price["result"]:
-                active.append(denom["denom"])
-        else:
-            active = hardfix_active_set
+def vote_messages(vote_price, vote_salt, active, v):
+    return [
+        {
+            "type": "oracle/MsgExchangeRateVote",
+            "value": {
+                "exchange_rate": str(vote_price[denom]),
+                "salt": str(vote_salt[denom]),
+                "denom": denom,
+                "feeder": v.feeder,
+                "validator": v.validator
+            }
+        } for denom in active
+    ]
+
+
+def metrics_for_result(quote):
+    if quote:
+        METRIC_EXCHANGE_ASK_PRICE.labels(quote.exchange, quote.base_currency).set(quote.askprice)
+        METRIC_EXCHANGE_BID_PRICE.labels(quote.exchange, quote.base_currency).set(quote.bidprice)
+        METRIC_EXCHANGE_MID_PRICE.labels(quote.exchange, quote.base_currency).set(quote.midprice)
+
+
+def convert_quote(quote, base_currency, real_fx):
+    """Re-expresses a quote in another base currency using the combined FX rates."""
+    ratio = real_fx[fx_map[base_currency]] / real_fx[fx_map[quote.base_currency]]
+    return Quote(quote.exchange, base_currency, quote.askprice * ratio, quote.bidprice * ratio, quote.midprice * ratio)
+
+
+class RoundTrace:
+    """Wall-clock time spent in each stage of one vote round.
+
+    Stages are closed with lap(); time between the ahead-of-boundary
+    preparation and the boundary itself is not counted (see restart()).
+    finish() exports the trace to Prometheus, the /rounds buffer and
+    ROUND_TIMING_LOG.
+    """
+
+    def __init__(self, target_round, height, block_seen_at, validator=None):
+        self.round = target_round
+        self.height = height
+        self.block_seen_at = block_seen_at
+        self.validator = validator
+        self.lap_start = time.time()
+        self.stages = collections.OrderedDict()
+        self.prepared_ahead = False
+
+    def fork(self, validator):
+        """Copy of the shared stages so far, continued for one validator."""
+        trace = RoundTrace(self.round, self.height, self.block_seen_at, validator)
+        trace.lap_start = self.lap_start
+        trace.stages.update(self.stages)
+        return trace
+
+    def lap(self, stage):
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.lap_start
+        self.lap_start = now
+
+    def restart(self, block_seen_at):
+        """Marks the boundary block of a round that was prepared ahead."""
+        self.prepared_ahead = True
+        self.block_seen_at = block_seen_at
+        self.lap_start = time.time()
+
+    def finish(self, outcome, broadcast_height, block_time=None, blocks_remaining=None):
+        now = time.time()
+        self.outcome = outcome
+        self.broadcast_height = broadcast_height
+        self.end_to_end = now - self.block_seen_at
+        self.blocks_remaining = blocks_remaining
+        self.broadcast_lag = None
+        try:
+            if block_time:
+                self.broadcast_lag = now - parse_block_time(block_time)
+        except ValueError:
+            logger.exception("Error parsing block time %s", block_time)
+
+        for stage, seconds in self.stages.items():
+            METRIC_ROUND_STAGE.labels(stage, outcome).observe(seconds)
+        METRIC_ROUND_DURATION.labels(outcome).observe(self.end_to_end)
+        if self.broadcast_lag is not None:
+            METRIC_BROADCAST_LAG.observe(self.broadcast_lag)
+        if blocks_remaining is not None:
+            METRIC_BLOCKS_REMAINING.set(blocks_remaining)
+        recent_rounds.append(self.as_dict())
+
+        if round_timing_log:
+            with open(round_timing_log, 'a') as timing_log:
+                timing_log.write(json.dumps(self.as_dict()) + "\n")
+
+    def as_dict(self):
+        return {
+            "round": self.round,
+            "validator": self.validator,
+            "height": self.height,
+            "broadcast_height": self.broadcast_height,
+            "outcome": self.outcome,
+            "prepared_ahead": self.prepared_ahead,
+            "stages": self.stages,
+            "end_to_end": self.end_to_end,
+            "broadcast_lag": self.broadcast_lag,
+            "blocks_remaining": self.blocks_remaining
+        }
 
-        logger.info("Active set: {}".format(active))
 
-        # combine fx from all sources
-        fx_err_flag, real_fx = combine_fx(res_fxs)
+# price: aggregated midprice (None when no venue is left), consensus: weighted median the venues were
+# checked against, dropped: {venue: "no_quote" | "wide_spread" | "diverged"}
+Aggregate = collections.namedtuple("Aggregate", ["price", "consensus", "dropped"])
+
+
+def weighted_median(values, weights, average_split=True):
+    """Weighted median; an even weight split averages the two middle prices, or takes the lower one."""
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    cumulative = np.cumsum(weights)
+    half = cumulative[-1] / 2.0
+    i = int(np.searchsorted(cumulative, half))
+    if average_split and np.isclose(cumulative[i], half) and i + 1 < len(values):
+        # the weight splits evenly between two prices
+        return float((values[i] + values[i + 1]) / 2.0)
+    return float(values[i])
+
+
+def weighted_trimmed_mean(values, weights, fraction):
+    """Weighted mean after cutting fraction of the total weight from each tail."""
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    cumulative = np.cumsum(weights)
+    low, high = cumulative[-1] * fraction, cumulative[-1] * (1.0 - fraction)
+    kept = np.clip(cumulative, low, high) - np.clip(cumulative - weights, low, high)
+    if kept.sum() <= 0:
+        return weighted_median(values, weights)
+    return float(np.dot(values, kept) / kept.sum())
+
+
+def aggregate_quotes(quotes, weights, method, max_divergence, max_spread, fraction=0.0):
+    """Combines the quotes of every venue with a positive weight into one midprice.
+
+    Venues without a quote or with a bid-ask spread wider than max_spread are
+    dropped first; the lower weighted median of the rest (always one of their
+    prices) is the consensus, and venues further than max_divergence from it
+    are dropped too. The survivors are combined by method ("weighted_median"
+    or "trimmed_mean").
+    """
+    names = [name for name, weight in weights.items() if weight > 0]
+    present = np.array([quotes.get(name) is not None for name in names], dtype=bool)
+    ask, bid, mid = (np.array([getattr(quotes[name], field) if ok else np.nan for name, ok in zip(names, present)],
+                              dtype=float) for field in ("askprice", "bidprice", "midprice"))
+    weight = np.array([weights[name] for name in names], dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wide = present & ~(ask / bid - 1.0 <= max_spread)
+        keep = present & ~wide
+        # always one of the venue prices: a midpoint between two sides could leave every venue diverged
+        consensus = weighted_median(mid[keep], weight[keep], average_split=False) if keep.any() else None
+        diverged = keep & ~(np.abs(mid / consensus - 1.0) <= max_divergence) if consensus else keep & False
+    keep &= ~diverged
+
+    dropped = collections.OrderedDict()
+    for i, name in enumerate(names):
+        if not present[i]:
+            dropped[name] = "no_quote"
+        elif wide[i]:
+            dropped[name] = "wide_spread"
+        elif diverged[i]:
+            dropped[name] = "diverged"
+
+    if not keep.any():
+        return Aggregate(None, consensus, dropped)
+    if method == "trimmed_mean":
+        price = weighted_trimmed_mean(mid[keep], weight[keep], fraction)
+    else:
+        price = weighted_median(mid[keep], weight[keep])
+    return Aggregate(price, consensus, dropped)
+
+
+# per-denom prices of one round, as parallel arrays in the order of denoms
+PriceTable = collections.namedtuple(
+    "PriceTable", ["denoms", "market_price", "swap_price", "change", "diverged", "vote_price"])
+
+
+def compute_price_table(active, swap_prices, real_fx, luna_usd_price, luna_midprice_krw, luna_base):
+    """Computes market prices, swap-price divergence and vote strings for all denoms at once.
+
+    Swap prices and FX rates are indexed by denom once; the arithmetic runs on
+    NumPy arrays instead of a nested scan per denom.
+    """
+    denoms = list(active)
+    swap_index = {row["denom"]: float(row["amount"]) for row in swap_prices}
+    fx = np.array([real_fx[fx_map[denom]] for denom in denoms], dtype=float)
+    swap = np.array([swap_index.get(denom, 0.00000001) for denom in denoms], dtype=float)
+
+    luna_usd_price = float(luna_usd_price)
+    market = luna_usd_price * fx
+    # the luna_base denom averages the exchange price with the USD price converted
+    base_mask = np.array([fx_map[denom] == luna_base for denom in denoms], dtype=bool)
+    luna_midprice_base_avg = (luna_midprice_krw + luna_usd_price * real_fx[luna_base]) / 2
+    market[base_mask] = luna_midprice_base_avg * fx[base_mask] / real_fx[luna_base]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = market / swap - 1.0
+    diverged = ~(np.abs(change) <= stop_oracle_trigger_recent_diverge)
+    vote = np.where(diverged, 0.0, market)
+
+    return PriceTable(
+        denoms,
+        market,
+        swap,
+        change,
+        diverged,
+        ["{0:.18f}".format(price) for price in vote.tolist()])
+
+
+def prepare_votes(chain, height, latest_block_height, latest_block_time, trace, deadline):
+    """Fetches every source until deadline and returns this round's active set and vote prices on chain."""
+    # Get external data
+    all_err_flag = False
+    ts = time.time()
+
+    (swap_price_err_flag, swap_price), market = market_cache.fetch(chain, deadline)
+    trace.lap("fetch")
+
+    quotes = {name: market[name] for name in exchange_adapters}
+    # extract backup luna price from band
+    band_quotes = market["band-luna"]
+
+    for quote in list(quotes.values()) + list(band_quotes.values()):
+        metrics_for_result(quote)
+
+    # Get active set of denoms
+    if swap_price["result"] is None:
+        swap_price["result"] = []
+    if not swap_price_err_flag:
+        for row in swap_price["result"]:
+            price_history.record("swap:" + chain.chain_id, row["denom"], row["amount"], ts)
+
+    if len(hardfix_active_set) == 0:
+        active = []
+        for denom in swap_price["result"]:
+            active.append(denom["denom"])
+    else:
+        active = hardfix_active_set
+
+    logger.info("Active set: {}".format(active))
+
+    # combine fx from all sources, served from the background-refreshed cache
+    fx_err_flag, real_fx = combine_fx(fx_cache.snapshot())
+    trace.lap("fx")
+
+    #sdr_err_flag, sdr_rate = res_sdr.result() sdr receive Option
+    '''sdr receive Option
+    if fx_err_flag or sdr_err_flag or coinone_err_flag or swap_price_err_flag:
+        all_err_flag = True
+    '''
+    if fx_err_flag:
+        all_err_flag = True
+
+    # fall back to the band price of a venue; one without any price is dropped from the aggregate
+    for name, adapter in exchange_adapters.items():
+        if quotes[name] is None or (name == reference_exchange and swap_price_err_flag):
+            backup = band_quotes.get(name)
+            if backup is not None and backup.base_currency != adapter.base_currency:
+                backup = None if fx_err_flag else convert_quote(backup, adapter.base_currency, real_fx)
+            quotes[name] = backup
+    if quotes[usd_reference_exchange] is None:
+        all_err_flag = True
+
+    if not all_err_flag:
+        #real_fx["USDSDR"] = float(sdr_rate) sdr receive Option
+        base_currency = exchange_adapters[reference_exchange].base_currency
+
+        # drop venues without a quote, wider than bid_ask_spread_max or diverging from the consensus
+        aggregate = aggregate_quotes(
+            quotes,
+            {name: adapter.weight for name, adapter in exchange_adapters.items() if adapter.base_currency == base_currency},
+            aggregation_method, stop_oracle_trigger_exchange_diverge, bid_ask_spread_max, trim_fraction)
+        for name, reason in aggregate.dropped.items():
+            METRIC_SOURCE_DROPPED.labels(name, reason).inc()
+            logger.info("Left %s out of the %s aggregate: %s", name, base_currency, reason)
+            if reason == "diverged" and price_divergence_alert:
+                alarm_content = base_currency + " market price diversion at height " + str(
+                    height) + "! consensus_price:" + str(
+                    "{0:.1f}".format(aggregate.consensus)) + ", " + name + "_price:" + str(
+                    "{0:.1f}".format(quotes[name].midprice))
+                alarm_content += "(percent_diff:" + str("{0:.4f}".format(
+                    (aggregate.consensus / quotes[name].midprice - 1.0) * 100.0)) + "%)"
+
+                logger.error(alarm_content)
+                alerts.alert(alarm_content, key=("venue-diverged", name))
+
+        if aggregate.price is None:
+            logger.error("No %s venue left to aggregate", base_currency)
+            all_err_flag = True
 
-        #sdr_err_flag, sdr_rate = res_sdr.result() sdr receive Option
-        coinone_err_flag, coinone_luna_price, coinone_luna_base, coinone_luna_midprice_krw = res_coinone.result()
-        bithumb_err_flag, bithumb_luna_price, bithumb_luna_base, bithumb_luna_midprice_krw = res_bithumb.result()
-        gopax_err_flag, gopax_luna_price, gopax_luna_base, gopax_luna_midprice_krw = res_gopax.result()
-        gdac_err_flag, gdac_luna_price, gdac_luna_base, gdac_luna_midprice_krw = res_gdac.result()
-        binance_err_flag, binance_luna_price = res_binance.result()
+    if not all_err_flag:
+        luna_midprice_krw = aggregate.price
 
-        # extract backup luna price from band
-        binance_backup, coinone_backup, bithumb_backup, gdac_backup, gopax_backup = res_band.result()
+        luna_base = fx_map[base_currency]
+        binance_luna_price = quotes[usd_reference_exchange].midprice
+    trace.lap("aggregate")
 
-        coinone_share = coinone_share_default
-        bithumb_share = bithumb_share_default
-        gopax_share = gopax_share_default
-        gdac_share = gdac_share_default
-        '''sdr receive Option
-        if fx_err_flag or sdr_err_flag or coinone_err_flag or swap_price_err_flag:
-            all_err_flag = True
-        '''
-        if fx_err_flag:
+    if not all_err_flag:
+        # reorganize data
+        try:
+            # get swap price / market price for every denom in one pass
+            price_table = compute_price_table(
+                active, swap_price["result"], real_fx, binance_luna_price, luna_midprice_krw, luna_base)
+
+            result = {
+                "index": int(ts / 60),
+                "timestamp": ts,
+                "block_height": latest_block_height,
+                "block_time": latest_block_time,
+                "price_table": price_table,
+                "real_fx": real_fx,
+                "luna_quotes": quotes
+            }
+        except:
+            # e.g. a denom of the active set without FX rate
+            logger.exception("Reorganize data error")
             all_err_flag = True
-        if coinone_err_flag or swap_price_err_flag:
-            if coinone_backup is None:
-                all_err_flag = True
-            else:
-                coinone_luna_price, coinone_luna_base, coinone_luna_midprice_krw = coinone_backup
-        if bithumb_err_flag:
-            if bithumb_backup is None:
-                bithumb_share = 0
-            else:
-                bithumb_luna_price, bithumb_luna_base, bithumb_luna_midprice_krw = bithumb_backup
-        if gopax_err_flag:
-            if gdac_backup is None:
-                gopax_share = 0
+    trace.lap("price_table")
+
+    this_price = {}
+
+    for denom in active:
+        this_price.update({denom: 0.0})
+
+    if not all_err_flag:
+
+        # prevote for current round
+        price_table = result["price_table"]
+        for i, denom in enumerate(price_table.denoms):
+            market_price = price_table.market_price[i]
+            swap_price_denom = price_table.swap_price[i]
+            METRIC_MARKET_PRICE.labels(denom).set(market_price)
+            METRIC_SWAP_PRICE.labels(denom).set(swap_price_denom)
+            if not price_table.diverged[i]:
+                logger.info("Prevoting " + denom + " : " + str(
+                    market_price) + "(percent_change:" + str("{0:.4f}".format(
+                    price_table.change[i] * 100.0)) + "%)")
             else:
-                gopax_luna_price, gopax_luna_base, gopax_luna_midprice_krw = gopax_backup
-        if gdac_err_flag:
-            if gopax_backup is None:
-                gdac_share = 0
-            else:
-                gdac_luna_price, gdac_luna_base, gdac_luna_midprice_krw = gdac_backup
-
-        if binance_err_flag:
-            if binance_backup is not None:
-                _, luna_base, band_luna_price = binance_backup
-                binance_luna_price = band_luna_price / real_fx[luna_base] # convert to USD
-
-        if not all_err_flag:
-            #real_fx["USDSDR"] = float(sdr_rate) sdr receive Option
-
-            # ignore bithumb if it diverge from coinone price or its bid-ask price is wider than bid_ask_spread_max
-            if bithumb_share > 0:
-                if abs(1.0 - float(bithumb_luna_midprice_krw) / float(
-                        coinone_luna_midprice_krw)) > stop_oracle_trigger_exchange_diverge or float(
-                    bithumb_luna_price["askprice"]) / float(
-                    bithumb_luna_price["bidprice"]) - 1 > bid_ask_spread_max:
-                    bithumb_share = 0
-                    if price_divergence_alert:
-                        alarm_content = denom + " market price diversion at height " + str(
-                            height) + "! coinone_price:" + str(
-                            "{0:.1f}".format(coinone_luna_midprice_krw)) + ", bithumb_price:" + str(
-                            "{0:.1f}".format(bithumb_luna_midprice_krw))
-                        alarm_content += "(percent_diff:" + str("{0:.4f}".format(
-                            (coinone_luna_midprice_krw / bithumb_luna_midprice_krw - 1.0) * 100.0)) + "%)"
-
-                        logger.error(alarm_content)
-                        telegram(alarm_content)
-                        slack(alarm_content)
-
-            # ignore gopax if it diverge from coinone price or its bid-ask price is wider than bid_ask_spread_max
-            if gopax_share > 0:
-                if abs(1.0 - float(gopax_luna_midprice_krw) / float(
-                        coinone_luna_midprice_krw)) > stop_oracle_trigger_exchange_diverge or float(
-                    gopax_luna_price["askprice"]) / float(
-                    gopax_luna_price["bidprice"]) - 1 > bid_ask_spread_max:
-                    gopax_share = 0
-                    if price_divergence_alert:
-                        alarm_content = denom + " market price diversion at height " + str(
-                            height) + "! coinone_price:" + str(
-                            "{0:.1f}".format(coinone_luna_midprice_krw)) + ", gopax_price:" + str(
-                            "{0:.1f}".format(gopax_luna_midprice_krw))
-                        alarm_content += "(percent_diff:" + str("{0:.4f}".format(
-                            (coinone_luna_midprice_krw / gopax_luna_midprice_krw - 1.0) * 100.0)) + "%)"
-
-                        logger.error(alarm_content)
-                        telegram(alarm_content)
-                        slack(alarm_content)
-
-            # ignore gdac if it diverge from coinone price or its bid-ask price is wider than bid_ask_spread_max
-            if gdac_share > 0:
-                if abs(1.0 - float(gdac_luna_midprice_krw) / float(
-                        coinone_luna_midprice_krw)) > stop_oracle_trigger_exchange_diverge or float(
-                    gdac_luna_price["askprice"]) / float(
-                    gdac_luna_price["bidprice"]) - 1 > bid_ask_spread_max:
-                    gdac_share = 0
-                    if price_divergence_alert:
-                        alarm_content = denom + " market price diversion at height " + str(
-                            height) + "! coinone_price:" + str(
-                            "{0:.1f}".format(coinone_luna_midprice_krw)) + ", gdac_price:" + str(
-                            "{0:.1f}".format(gdac_luna_midprice_krw))
-                        alarm_content += "(percent_diff:" + str("{0:.4f}".format(
-                            (coinone_luna_midprice_krw / gdac_luna_midprice_krw - 1.0) * 100.0)) + "%)"
-
-                        logger.error(alarm_content)
-                        telegram(alarm_content)
-                        slack(alarm_content)
-
-            # vote negative price if coinone bid-ask spread is wider than "bid_ask_spread_max"
-            if float(coinone_luna_price["askprice"]) / float(
-                    coinone_luna_price["bidprice"]) - 1 > bid_ask_spread_max:
-                all_err_flag = True
-
-        if not all_err_flag:
-            # Weighted average
-            luna_midprice_krw = (
-                    (float(coinone_luna_midprice_krw) * coinone_share +
-                     float(bithumb_luna_midprice_krw) * bithumb_share +
-                     float(gopax_luna_midprice_krw) * gopax_share +
-                     float(gdac_luna_midprice_krw) * gdac_share
-                     ) / (coinone_share + bithumb_share + gopax_share + gdac_share)
-            )
-
-            luna_base = coinone_luna_base
-
-            # reorganize data
-            try:
-                # get swap price / market price
-                swap_price_compare = []
+                alarm_content = denom + " price diversion at height " + str(
+                    height) + "! market_price:" + str(
+                    "{0:.4f}".format(market_price)) + ", swap_price:" + str(
+                    "{0:.4f}".format(swap_price_denom))
+                alarm_content += "(percent_change:" + str("{0:.4f}".format(
+                    price_table.change[i] * 100.0)) + "%)"
+                logger.info(alarm_content)
+                alerts.alert(alarm_content, key=("denom-diverged", chain.chain_id, denom))
+
+            # vote negative when the denom diverged
+            this_price[denom] = price_table.vote_price[i]
+            price_history.record("vote:" + chain.chain_id, denom, this_price[denom], ts)
+
+    if all_err_flag:  # vote negative when all_err_flag == True
+        for denom in active:
+            this_price[denom] = str("{0:.18f}".format(float(0)))
+
+    # vote abstain(0) for all denoms in abstain_set
+    for denom in abstain_set:
+        this_price[denom] = str("{0:.18f}".format(float(0)))
+
+    return active, this_price
 
-                for currency in active:
-                    market_price = float(binance_luna_price) * real_fx[fx_map[currency]]
-                    this_swap_price = 0.00000001
 
-                    if currency == "ukrw":
-                        luna_binance_usdttokrw = float(binance_luna_price) * real_fx[luna_base]
-                        luna_midprice_krw_binance_avg = float((luna_midprice_krw + luna_binance_usdttokrw)/2)
-                        market_price = float(luna_midprice_krw_binance_avg * (real_fx[fx_map[currency]] / real_fx[luna_base]))
+def hash_votes(this_price, v):
+    """Salts and prevote hashes of v for every priced denom."""
+    this_salt = {}
+    this_hash = {}
+    for denom in this_price:
+        this_salt[denom] = get_salt(str(time.time()) + v.validator)
+        this_hash[denom] = get_hash(this_salt[denom], this_price[denom], denom, v.validator)
+    return this_salt, this_hash
 
 
-                    for denom in swap_price["result"]:
-                        if denom["denom"] == currency:
-                            this_swap_price = float(denom["amount"])
+def check_hash_match(last_hash, v):
+    """True when every hash v prevoted last round is on chain, i.e. it can reveal."""
+    my_current_prevotes = get_my_current_prevotes(v)
+
+    hash_match_flag = False
+    try:
+        if last_hash:
+            hash_match_flag = True
+
+            for vote_hash in last_hash:
+                this_hash_exist = False
+                if my_current_prevotes:
+                    for prevote in my_current_prevotes:
+                        if str(prevote["hash"]) == vote_hash:
+                            this_hash_exist = True
                             break
+                if not this_hash_exist:
+                    hash_match_flag = False
+                    break
+    except:
+        logging.exception("check hash match ERROR except")
+        hash_match_flag = False
+
+    return hash_match_flag
+
+
+class PrevoteLedger:
+    """The prevotes we broadcast, per round, and whether they made it on chain.
+
+    Status moves from "broadcast" (accepted by CheckTx) to "included" or
+    "rejected" as our Tx events arrive. Failed txs emit no event we are
+    subscribed to, so reconcile() looks every unresolved tx up by hash, off
+    the critical path; the LCD prevote query is only the fallback when the
+    tx cannot be found.
+    """
+
+    def __init__(self, fetch_prevotes, lookup_tx=None, keep=4):
+        self.fetch_prevotes = fetch_prevotes
+        self.lookup_tx = lookup_tx
+        self.keep = keep
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, target_round, hashes, result, height):
+        """Records the broadcast of target_round's prevote hashes with its broadcast result."""
+        status = "broadcast" if int(result.get("code", 0) or 0) == 0 else "rejected"
+        if status == "rejected":
+            logger.error("Round %d tx rejected: %s", target_round, result.get("raw_log"))
+        with self.lock:
+            self.entries[target_round] = {
+                "hashes": list(hashes),
+                "txhash": str(result.get("txhash", "")).upper(),
+                "height": height,
+                "status": status
+            }
+            while len(self.entries) > self.keep:
+                self.entries.popitem(last=False)
 
-                    swap_price_compare.append(
-                        {"market": currency, "swap_price": this_swap_price, "market_price": market_price})
-
-                result = {
-                    "index": int(ts / 60),
-                    "timestamp": ts,
-                    "block_height": latest_block_height,
-                    "block_time": latest_block_time,
-                    "swap_price_compare": swap_price_compare,
-                    "real_fx": real_fx,
-                    "luna_price_list": [coinone_luna_price, bithumb_luna_price, gopax_luna_price]
-                }
-            except:
-                # TODO: how can this fail?
-                logger.exception("Reorganize data error")
-                all_err_flag = True
+    def observe_tx(self, tx_result):
+        """Confirms or rejects the entry of one of our txs from its Tx event."""
+        try:
+            txhash = hashlib.sha256(base64.b64decode(tx_result["tx"])).hexdigest().upper()
+            code = int(tx_result.get("result", {}).get("code", 0) or 0)
+            with self.lock:
+                for target_round, entry in self.entries.items():
+                    if entry["txhash"] == txhash:
+                        entry["status"] = "included" if code == 0 else "rejected"
+                        entry["height"] = int(tx_result.get("height", entry["height"]))
+                        logger.info("Round %d tx %s at height %d", target_round, entry["status"], entry["height"])
+        except:
+            logger.exception("Error while processing Tx event")
+
+    def reconcile(self, target_round):
+        """Resolves target_round's tx by hash, else checks its hashes against the LCD prevotes."""
+        with self.lock:
+            entry = self.entries.get(target_round)
+        if entry is None or entry["status"] == "rejected":
+            return
+        if entry["status"] == "broadcast" and entry["txhash"] and self.lookup_tx is not None:
+            result = self.lookup_tx(entry["txhash"])
+            if result:
+                with self.lock:
+                    entry["status"] = "included" if result["code"] == 0 else "rejected"
+                    entry["height"] = result["height"]
+                logger.info("Round %d tx %s at height %d", target_round, entry["status"], entry["height"])
+                return
+        my_current_prevotes = self.fetch_prevotes()
+        if my_current_prevotes is False:
+            return
+        on_chain = set(str(prevote["hash"]) for prevote in my_current_prevotes)
+        found = all(vote_hash in on_chain for vote_hash in entry["hashes"])
+        with self.lock:
+            if found:
+                entry["status"] = "included"
+            elif entry["status"] == "included":
+                logger.warning("Round %d prevotes confirmed by Tx event but missing on LCD", target_round)
+            else:
+                entry["status"] = "missing"
+                logger.warning("Round %d prevotes are not on chain", target_round)
+
+    def schedule_reconcile(self, target_round, delay):
+        timer = threading.Timer(delay, self.reconcile, [target_round])
+        timer.daemon = True
+        timer.start()
+
+    def can_reveal(self, hashes):
+        """True when the prevote of these hashes is on chain, False when it was rejected, None when unsure."""
+        if not hashes:
+            return False
+        with self.lock:
+            for entry in self.entries.values():
+                if entry["hashes"] == list(hashes):
+                    if entry["status"] == "included":
+                        return True
+                    if entry["status"] == "rejected":
+                        return False
+        return None
+
+
+class Validator:
+    """A validator/feeder pair voting on one chain, and what it prevoted last round."""
+
+    def __init__(self, chain, validator, feeder, key_name, key_password, home_cli, signing_mode,
+                 feeder_private_key, feeder_mnemonic, feeder_hd_path, name="", misses=0, primary=False):
+        self.chain = chain
+        self.validator = validator
+        self.feeder = feeder
+        self.key_name = key_name
+        self.key_password = key_password
+        self.home_cli = home_cli
+        self.signing_mode = signing_mode
+        self.feeder_private_key = feeder_private_key
+        self.feeder_mnemonic = feeder_mnemonic
+        self.feeder_hd_path = feeder_hd_path
+        self.name = name
+        self.misses = misses
+        # the unlabelled height/misses metrics follow the first validator
+        self.primary = primary
+        self.feeder_key = None
+        self.account = account_state(chain, feeder)
+        self.ledger = PrevoteLedger(lambda: get_my_current_prevotes(self), chain.lookup_tx)
+        self.prepared = None
+        self.forget_last_round()
+
+    def remember_round(self, prepared):
+        """What to reveal next round, from the prepared round just broadcast."""
+        self.last_active = list(prepared["active"])
+        self.last_price = {denom: prepared["price"][denom] for denom in self.last_active}
+        self.last_salt = {denom: prepared["salt"][denom] for denom in self.last_active}
+        self.last_hash = [prepared["hash"][denom] for denom in self.last_active]
+
+    def forget_last_round(self):
+        """Nothing to reveal next round, e.g. after a failed broadcast."""
+        self.last_active = []
+        self.last_hash = []
+        self.last_price = {}
+        self.last_salt = {}
+
+
+class Chain:
+    """LCD/RPC pools and block source of a chain, shared by the validators voting on it."""
+
+    def __init__(self, chain_id, lcd_pool, rpc_pool):
+        self.chain_id = chain_id
+        self.lcd_pool = lcd_pool
+        self.rpc_pool = rpc_pool
+        self.validators = []
+        self.block_source = None
+        self.last_prevoted_round = 0
+        self.prepared_round = None
+        # (round, active, prices, trace) of the last prepare_round, to prepare failed validators again
+        self.prepared_votes = None
+
+    def start(self):
+        poll = functools.partial(get_latest_block, self.lcd_pool)
+        if block_websocket:
+            self.block_source = BlockSource(
+                async_runtime, lambda: rpc_websocket_url(self.rpc_pool.best()), poll=poll,
+                stall_timeout=block_stall_timeout,
+                tx_queries=["tm.event='Tx' AND message.sender='{}'".format(feeder_address)
+                            for feeder_address in sorted(set(v.feeder for v in self.validators))],
+                on_tx=self.observe_tx).start()
+        else:
+            self.block_source = BlockSource(async_runtime, None, poll=poll)
+        return self
+
+    def observe_tx(self, tx_result):
+        for v in self.validators:
+            v.ledger.observe_tx(tx_result)
+        self.tx_failed(int(tx_result.get("result", {}).get("code", 0) or 0))
+
+    def lookup_tx(self, txhash):
+        """Looks up the outcome of one of our txs by hash; returns it like get_tx_result.
+
+        A tx failing in DeliverTx emits no message events, so the Tx
+        subscription (filtered on message.sender) never sees it.
+        """
+        result = get_tx_result(txhash, self.lcd_pool)
+        if result:
+            if result["code"] != 0:
+                logger.warning("Tx %s failed at height %d: %s", txhash, result["height"], result["raw_log"])
+            self.tx_failed(result["code"])
+        return result
 
-        this_price = {}
-        this_hash = {}
-        this_salt = {}
+    def tx_failed(self, code):
+        if code != 0:
+            # e.g. out of gas: the simulated gas may no longer fit, use the static fee until simulated again
+            logger.warning("A tx on %s failed with code %d, simulating the fees again", self.chain_id, code)
+            fee_estimator.forget(self)
+
+
+def endpoint_pools(entry, entry_chain_id):
+    """LCD and RPC pools of a VALIDATORS_FILE entry; the TERRA_LCD/NODE_RPC pools unless it names its own."""
+    chain_lcd_pool, chain_rpc_pool = lcd_pool, rpc_pool
+    if "terra_lcd" in entry and not mock_lcd:
+        chain_lcd_pool = EndpointPool(
+            "lcd-" + entry_chain_id,
+            [address.strip().rstrip("/") for address in entry["terra_lcd"].split(",") if address.strip()],
+            probe_path="/blocks/latest", parse_height=lcd_height,
+            max_height_lag=endpoint_max_height_lag).start(endpoint_probe_interval)
+    if "node_rpc" in entry and not mock_lcd:
+        chain_rpc_pool = EndpointPool(
+            "rpc-" + entry_chain_id,
+            [address.strip() for address in entry["node_rpc"].split(",") if address.strip()],
+            url=rpc_http_url, probe_path="/status", parse_height=rpc_height,
+            max_height_lag=endpoint_max_height_lag).start(endpoint_probe_interval)
+    return chain_lcd_pool, chain_rpc_pool
+
+
+def load_chains():
+    """Groups the validators of VALIDATORS_FILE by chain (or the single validator of the settings above)."""
+    entries = [{}]
+    if validators_file:
+        with open(validators_file) as config:
+            entries = json.load(config)
+    chains = collections.OrderedDict()
+    for entry in entries:
+        entry_chain_id = entry.get("chain_id", chain_id)
+        if entry_chain_id not in chains:
+            chains[entry_chain_id] = Chain(entry_chain_id, *endpoint_pools(entry, entry_chain_id))
+        chain = chains[entry_chain_id]
+        chain.validators.append(Validator(
+            chain,
+            entry.get("validator", validator),
+            entry.get("feeder", feeder),
+            entry.get("key_name", key_name),
+            entry["key_password"].encode() if "key_password" in entry else key_password,
+            entry.get("home_cli", home_cli),
+            entry.get("signing_mode", signing_mode),
+            entry.get("feeder_private_key", feeder_private_key),
+            entry.get("feeder_mnemonic", feeder_mnemonic),
+            entry.get("feeder_hd_path", feeder_hd_path),
+            name=entry.get("name", ""),
+            misses=int(entry.get("misses", misses)),
+            primary=entry is entries[0]))
+    return list(chains.values())
+
+
+class VoteStateStore:
+    """Append-only, fsync'd log of the prevote each validator is about to broadcast.
+
+    Replayed on startup so the salts of the pending prevote survive a crash or
+    deploy and the next round can still reveal. A torn last line is ignored;
+    the log is compacted to the latest record per validator when it grows.
+    """
+
+    def __init__(self, path, max_records=1000):
+        self.path = path
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        self.latest = self._load()
+        self._rewrite()
+        self.file = open(self.path, "a")
+        self.records = len(self.latest)
+
+    def _load(self):
+        latest = collections.OrderedDict()
+        if not os.path.exists(self.path):
+            return latest
+        with open(self.path) as state:
+            for line in state:
+                try:
+                    record = json.loads(line)
+                    latest[(record["chain_id"], record["validator"])] = record
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("Ignoring a damaged vote state record in %s", self.path)
+        return latest
+
+    def _rewrite(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as state:
+            for record in self.latest.values():
+                state.write(json.dumps(record) + "\n")
+            state.flush()
+            os.fsync(state.fileno())
+        os.replace(temp_path, self.path)
+
+    def save(self, v, prepared):
+        """Durably records v's prepared prevote; returns once it is on disk."""
+        record = {
+            "chain_id": v.chain.chain_id,
+            "validator": v.validator,
+            "round": prepared["round"],
+            "active": list(prepared["active"]),
+            "price": {denom: prepared["price"][denom] for denom in prepared["active"]},
+            "salt": {denom: prepared["salt"][denom] for denom in prepared["active"]},
+            "hash": [prepared["hash"][denom] for denom in prepared["active"]]
+        }
+        with self.lock:
+            self.latest[(record["chain_id"], record["validator"])] = record
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.records += 1
+            if self.records > self.max_records:
+                self.file.close()
+                self._rewrite()
+                self.file = open(self.path, "a")
+                self.records = len(self.latest)
+
+    def restore(self, chains):
+        """Reloads the pending prevote of every configured validator."""
+        for chain in chains:
+            for v in chain.validators:
+                record = self.latest.get((chain.chain_id, v.validator))
+                if record is None:
+                    continue
+                v.last_active = record["active"]
+                v.last_price = record["price"]
+                v.last_salt = record["salt"]
+                v.last_hash = record["hash"]
+                chain.last_prevoted_round = max(chain.last_prevoted_round, record["round"])
+                logger.info("Restored the round %d prevote of %s", record["round"], v.validator)
+
+
+def fan_out(function, validators):
+    """Runs function(v) for every validator and returns the results in order.
+
+    Validators sharing a feeder account run one after another, so their txs
+    take consecutive sequences and reach the mempool in sequence order; the
+    other feeders run in parallel (inline when there is only one).
+    """
+    groups = collections.OrderedDict()
+    for v in validators:
+        groups.setdefault(id(v.account), []).append(v)
+
+    def run_group(group):
+        return [(v, function(v)) for v in group]
+
+    if len(groups) == 1:
+        results = run_group(validators)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            results = [result for group in executor.map(run_group, groups.values()) for result in group]
+    by_validator = {id(v): result for v, result in results}
+    return [by_validator[id(v)] for v in validators]
+
+
+def prepare_validator_round(v, target_round, active, this_price, trace):
+    """Hashes, checks the reveal and signs target_round's tx for one validator."""
+    trace = trace.fork(v.validator)
+    this_salt, this_hash = hash_votes(this_price, v)
+    trace.lap("hash")
+
+    hash_match_flag = v.ledger.can_reveal(v.last_hash)
+    if dry_run:
+        # nothing was prevoted on chain, reveal as if the last round's prevote had been
+        hash_match_flag = bool(v.last_hash)
+    elif hash_match_flag is None:
+        # no confirmation yet, ask the LCD on the critical path
+        hash_match_flag = check_hash_match(v.last_hash, v)
+    trace.lap("prevote_check")
+
+    if hash_match_flag:  # if all hashes exist
+        # vote/prevote at the same time!
+        logger.info("Signing votes/prevotes at the same time...")
+        messages = vote_messages(v.last_price, v.last_salt, v.last_active, v) + prevote_messages(this_hash, active, v)
+    else:
+        logger.info("Signing prevotes only...")
+        messages = prevote_messages(this_hash, active, v)
 
-        for denom in active:
-            this_price.update({denom: 0.0})
-            this_hash.update({denom: ""})
-            this_salt.update({denom: ""})
-
-        if not all_err_flag:
-
-            # prevote for current round
-            for denom in active:
-                for prices in result["swap_price_compare"]:
-                    if prices["market"] == denom:
-                        METRIC_MARKET_PRICE.labels(denom).set(prices["market_price"])
-                        METRIC_SWAP_PRICE.labels(denom).set(prices["swap_price"])
-                        this_denom_err_flag = False
-                        if abs(prices["market_price"] / prices[
-                            "swap_price"] - 1.0) <= stop_oracle_trigger_recent_diverge:
-                            logger.info("Prevoting " + denom + " : " + str(
-                                prices["market_price"]) + "(percent_change:" + str("{0:.4f}".format(
-                                (prices["market_price"] / prices["swap_price"] - 1.0) * 100.0)) + "%)")
-                        else:
-                            alarm_content = denom + " price diversion at height " + str(
-                                height) + "! market_price:" + str(
-                                "{0:.4f}".format(prices["market_price"])) + ", swap_price:" + str(
-                                "{0:.4f}".format(prices["swap_price"]))
-                            alarm_content += "(percent_change:" + str("{0:.4f}".format(
-                                (prices["market_price"] / prices["swap_price"] - 1.0) * 100.0)) + "%)"
-                            logger.info(alarm_content)
-                            telegram(alarm_content)
-                            slack(alarm_content)
-                            this_denom_err_flag = True
-
-                        this_salt[denom] = get_salt(str(time.time()))
-                        if this_denom_err_flag == False:  # vote negative when this_denom_err_flag == True
-                            this_price[denom] = str("{0:.18f}".format(float(prices["market_price"])))
-                        else:
-                            this_price[denom] = str("{0:.18f}".format(float(0)))
-                        this_hash[denom] = get_hash(this_salt[denom], this_price[denom], denom, validator)
-                        break
-
-        if all_err_flag:  # vote negative when all_err_flag == True
-            for denom in active:
-                this_price[denom] = str("{0:.18f}".format(float(0)))
-                this_salt[denom] = get_salt(str(time.time()))
-                this_hash[denom] = get_hash(this_salt[denom], this_price[denom], denom, validator)
-
-        # vote abstain(0) for all denoms in abstain_set
-        for denom in abstain_set:
-            this_price[denom] = str("{0:.18f}".format(float(0)))
-            this_salt[denom] = get_salt(str(time.time()))
-            this_hash[denom] = get_hash(this_salt[denom], this_price[denom], denom, validator)
+    tx_json_signed = sign_messages(messages, v)
+    trace.lap("sign")
 
-        logger.info("Start voting on height " + str(height + 1))
+    if active and all(float(this_price[denom]) == 0 for denom in active):
+        outcome = "negative"
+    else:
+        outcome = "vote_prevote" if hash_match_flag else "prevote_only"
+
+    return {
+        "round": target_round,
+        "active": active,
+        "price": this_price,
+        "salt": this_salt,
+        "hash": this_hash,
+        "vote": hash_match_flag,
+        "outcome": outcome,
+        "messages": messages,
+        "tx": tx_json_signed,
+        "trace": trace
+    }
+
+
+def prepare_round(chain, target_round, height, latest_block_height, latest_block_time, block_seen_at):
+    """Computes target_round's prices once for chain, then builds and signs every validator's tx.
 
-        # check hash match
-        my_current_prevotes = get_my_current_prevotes()
+    Only the broadcast is left at the boundary.
+    """
+    for v in chain.validators:
+        if v.prepared is not None:
+            # a boundary was skipped; the sequence its tx reserved was never used
+            logger.warning("Dropping the unsent round %d tx of %s", v.prepared["round"], v.validator)
+            v.prepared = None
+            v.account.invalidate()
+    trace = RoundTrace(target_round, height, block_seen_at)
+    deadline = block_seen_at + fetch_budget_blocks * chain.block_source.block_interval
+    active, this_price = prepare_votes(chain, height, latest_block_height, latest_block_time, trace, deadline)
+    logger.info("Prepared votes for round %d at height %d", target_round, height)
+    chain.prepared_votes = (target_round, active, this_price, trace)
+    prepare_validators(chain, chain.validators)
+    chain.prepared_round = target_round
 
+
+def prepare_validators(chain, validators):
+    """Builds and signs the tx of each of validators from the votes prepare_round computed for chain."""
+    target_round, active, this_price, trace = chain.prepared_votes
+
+    def prepare(v):
         try:
-            if not last_hash:
-                hash_match_flag = False
-            else:
-                hash_match_flag = True
-
-                for vote_hash in last_hash:
-                    this_hash_exist = False
-                    if my_current_prevotes != bool:
-                        for prevote in my_current_prevotes:
-                            if str(prevote["hash"]) == vote_hash:
-                                this_hash_exist = True
-                                break
-                    if not this_hash_exist:
-                        hash_match_flag = False
-                        break
+            return prepare_validator_round(v, target_round, active, this_price, trace)
         except:
-            logging.exception("check hash match ERROR except")
+            logger.exception("Error while preparing round %d for %s", target_round, v.validator)
+            # signing may have reserved a sequence
+            v.account.invalidate()
+            return None
+
+    for v, prepared in zip(validators, fan_out(prepare, validators)):
+        v.prepared = prepared
+
+
+def prepare_missing_validators(chain, target_round):
+    """Prepares again, at the boundary, every validator whose tx could not be prepared ahead of it."""
+    missing = [v for v in chain.validators if v.prepared is None]
+    if missing and chain.prepared_votes is not None and chain.prepared_votes[0] == target_round:
+        logger.warning("Preparing round %d again for %s", target_round, ", ".join(v.validator for v in missing))
+        prepare_validators(chain, missing)
+
+
+def broadcast_round(v, target_round, height, latest_block_time):
+    """Broadcasts v's prepared tx for target_round and remembers what to reveal next round."""
+    prepared = v.prepared
+    v.prepared = None
+    if prepared is None or prepared["round"] != target_round:
+        logger.error("No tx prepared for %s in round %d", v.validator, target_round)
+        if prepared is not None:
+            # its sequence was reserved but is not used
+            v.account.invalidate()
+        v.forget_last_round()
+        return
 
-        if hash_match_flag:  # if all hashes exist
-            # broadcast vote/prevote at the same time!
-            logger.info("Broadcast votes/prevotes at the same time...")
-            broadcast_all(last_price, last_salt, this_hash)
-            METRIC_VOTES.inc()
-        else:
-            logger.info("Broadcast prevotes only...")
-            broadcast_prevote(this_hash)
-
-        # update last_prevoted_round
-        last_prevoted_round = next_height_round
-        last_price = {}
-        last_salt = {}
-        last_hash = []
-        last_active = []
-        for denom in active:
-            last_price.update({denom: 0.0})
-            last_salt.update({denom: ""})
-        for denom in active:
-            last_price[denom] = this_price[denom]
-            last_salt[denom] = this_salt[denom]
-            last_active.append(denom)
-            last_hash.append(this_hash[denom])
-        last_swap_price = []
-        for item in swap_price:
-            last_swap_price.append(item)
+    if vote_state is not None:
+        try:
+            vote_state.save(v, prepared)
+        except:
+            logger.exception("Error while saving the vote state")
+        prepared["trace"].lap("persist")
 
-        # Get last amount of misses, if this increased message telegram
-        currentmisses, currentheight = get_current_misses()
+    logger.info("Start voting on height " + str(height + 1))
+    if dry_run:
+        finish_dry_run(v, target_round, height, latest_block_time, prepared)
+        return
+    try:
+        broadcast_result = broadcast_signed(prepared["tx"], v)
+        if sequence_mismatch(broadcast_result):
+            logger.warning("Sequence of %s is out of sync, resigning: %s", v.feeder, broadcast_result.get("raw_log"))
+            v.account.invalidate()
+            broadcast_result = broadcast_signed(sign_messages(prepared["messages"], v), v)
+    except:
+        logger.exception("Error while broadcasting round %d for %s", target_round, v.validator)
+        # the tx may or may not have reached the mempool
+        v.account.invalidate()
+        v.forget_last_round()
+        return
+    if int(broadcast_result.get("code", 0) or 0) != 0:
+        # a rejected tx does not use its sequence
+        v.account.invalidate()
+        if int(broadcast_result["code"]) == 11:
+            fee_estimator.forget(v.chain)
+    prepared["trace"].lap("broadcast")
+    v.ledger.record(target_round, [prepared["hash"][denom] for denom in prepared["active"]],
+                    broadcast_result, height)
+    finish_trace(v, target_round, height, latest_block_time, prepared)
+    if prepared["vote"]:
+        METRIC_VOTES.inc()
+
+    v.remember_round(prepared)
+
+    # also looks the tx up by hash, see PrevoteLedger.reconcile
+    v.ledger.schedule_reconcile(target_round, 2 * v.chain.block_source.block_interval)
+
+
+def finish_trace(v, target_round, height, latest_block_time, prepared):
+    """Closes the round trace at the chain head seen now, which may be past the height that started the round."""
+    broadcast_height = v.chain.block_source.latest_height or height
+    prepared["trace"].finish(prepared["outcome"], broadcast_height, latest_block_time,
+                             int((target_round + 1) * round_block_num - broadcast_height))
+
+
+dry_run_lock = threading.Lock()
+
+
+def finish_dry_run(v, target_round, height, latest_block_time, prepared):
+    """Logs the tx v would have broadcast for target_round to DRY_RUN_LOG."""
+    prepared["trace"].lap("broadcast")
+    finish_trace(v, target_round, height, latest_block_time, prepared)
+    record = {
+        "chain_id": v.chain.chain_id,
+        "validator": v.validator,
+        "round": target_round,
+        "height": height,
+        "outcome": prepared["outcome"],
+        "price": {denom: prepared["price"][denom] for denom in prepared["active"]},
+        "messages": prepared["messages"],
+        "fee": prepared["tx"]["value"]["fee"],
+        "trace": prepared["trace"].as_dict()
+    }
+    with dry_run_lock:
+        with open(dry_run_log, "a") as log:
+            log.write(json.dumps(record) + "\n")
+    logger.info("Dry run: logged the round %d tx of %s", target_round, v.validator)
+
+    v.remember_round(prepared)
 
+
+def update_misses(v):
+    """Get last amount of misses, if this increased message telegram"""
+    currentmisses, currentheight = get_current_misses(v)
+
+    if v.primary:
         METRIC_HEIGHT.set(currentheight)
         METRIC_MISSES.set(currentmisses)
+    METRIC_VALIDATOR_MISSES.labels(v.validator).set(currentmisses)
 
-        if currentheight > 0:
-            misspercentage = round(float(currentmisses) / float(currentheight) * 100, 2)
-            logger.info("Current miss percentage: {}%".format(misspercentage))
+    misspercentage = 0
+    if currentheight > 0:
+        misspercentage = round(float(currentmisses) / float(currentheight) * 100, 2)
+        logger.info("Current miss percentage: {}%".format(misspercentage))
 
-        if misses == 0:
-            misses = currentmisses
+    if v.misses == 0:
+        v.misses = currentmisses
 
-        if currentmisses > misses:
-            # we have new misses, alert telegram
-            alarm_content = "Terra Oracle misses went from {} to {} ({}%)".format(
-                misses, currentmisses, misspercentage)
-            logger.error(alarm_content)
+    if currentmisses > v.misses:
+        # we have new misses, alert telegram
+        alarm_content = "Terra Oracle misses{} went from {} to {} ({}%)".format(
+            " of " + v.name if v.name else "", v.misses, currentmisses, misspercentage)
+        logger.error(alarm_content)
 
-            if alertmisses:
-                telegram(alarm_content)
-                slack(alarm_content)
+        if alertmisses:
+            alerts.alert(alarm_content)
 
-            misses = currentmisses
+        v.misses = currentmisses
 
-    else:
-        logger.info("{height}: wait {num_blocks} blocks until this round ends...".format(
-            height=height,
-            num_blocks=num_blocks_till_next_round))
 
-    time.sleep(1)
+class StartupTimer:
+    """Times the start-up stages, from loading the module to the first block of every chain (ready to vote)."""
+
+    def __init__(self, started_at):
+        self.lap_start = started_at
+        self.started_at = started_at
+        self.stages = collections.OrderedDict()
+        self.waiting = None
+        self.lock = threading.Lock()
+
+    def lap(self, stage):
+        now = time.time()
+        self.stages[stage] = now - self.lap_start
+        self.lap_start = now
+        METRIC_STARTUP_STAGE.labels(stage).set(self.stages[stage])
+
+    def expect(self, chains):
+        self.waiting = set(chain.chain_id for chain in chains)
+
+    def chain_ready(self, chain):
+        with self.lock:
+            if not self.waiting or chain.chain_id not in self.waiting:
+                return
+            self.waiting.discard(chain.chain_id)
+            if self.waiting:
+                return
+            self.lap("first_block")
+            total = time.time() - self.started_at
+            METRIC_STARTUP.set(total)
+            logger.info("Ready to vote %.2fs after start (%s)", total, ", ".join(
+                "{} {:.2f}s".format(stage, seconds) for stage, seconds in self.stages.items()))
+
+
+startup_timer = StartupTimer(process_started_at)
+
+
+def run_chain(chain):
+    """Votes every round of chain for all of its validators."""
+    last_height = 0
+
+    main_err_flag = True
+    while main_err_flag:
+        latest_block_err_flag, latest_block_height, latest_block_time = chain.block_source.wait_for_block(last_height)
+        if latest_block_err_flag == False:
+            height = latest_block_height
+            if height > last_height:
+                main_err_flag = False
+                last_height = height
+    startup_timer.chain_ready(chain)
+
+    while True:
+
+        main_err_flag = True
+        while main_err_flag:
+            latest_block_err_flag, latest_block_height, latest_block_time = chain.block_source.wait_for_block(
+                last_height)
+            if latest_block_err_flag == False:
+                height = latest_block_height
+                if height > last_height:
+                    main_err_flag = False
+                    last_height = height
+        block_seen_at = time.time()
+
+        current_round = int(float(height - 1) / round_block_num)
+        next_height_round = int(float(height) / round_block_num)
+
+        num_blocks_till_next_round = (current_round + 1) * round_block_num - height
+
+        logger.debug("current_round: %d", current_round)
+        logger.debug("next_height_round: %d", next_height_round)
+        logger.debug("last_prevoted_round: %d", chain.last_prevoted_round)
+        logger.debug("height: %d", height)
+        logger.debug("num_blocks_till_next_round: %d", num_blocks_till_next_round)
+
+        try:
+            if next_height_round > chain.last_prevoted_round and (
+                    num_blocks_till_next_round == 0 or num_blocks_till_next_round > 3):
+
+                if chain.prepared_round != next_height_round:
+                    try:
+                        prepare_round(chain, next_height_round, height, latest_block_height, latest_block_time,
+                                      block_seen_at)
+                    except:
+                        logger.exception("Error while preparing votes")
+                        for v in chain.validators:
+                            v.prepared = None
+                else:
+                    for v in chain.validators:
+                        if v.prepared is not None:
+                            v.prepared["trace"].restart(block_seen_at)
+                    try:
+                        prepare_missing_validators(chain, next_height_round)
+                    except:
+                        logger.exception("Error while preparing votes")
+
+                try:
+                    fan_out(lambda v: broadcast_round(v, next_height_round, height, latest_block_time),
+                            chain.validators)
+                    price_history.flush()
+                finally:
+                    # update last_prevoted_round, even after a failure: some validators may have broadcast
+                    chain.last_prevoted_round = next_height_round
+                    chain.prepared_round = None
+
+                if not dry_run:
+                    # after every broadcast, so a miss query never holds back the next tx of a shared feeder
+                    try:
+                        fan_out(update_misses, chain.validators)
+                    except:
+                        logger.exception("Error while updating the misses")
+
+            elif 0 < num_blocks_till_next_round <= pipeline_lead_blocks and \
+                    current_round + 1 > chain.last_prevoted_round and chain.prepared_round != current_round + 1:
+                # build and sign ahead of the boundary, only the broadcast is left on the critical path
+                try:
+                    prepare_round(chain, current_round + 1, height, latest_block_height, latest_block_time,
+                                  block_seen_at)
+                except:
+                    logger.exception("Error while preparing votes ahead of the round boundary")
+                    chain.prepared_round = None
+
+            else:
+                logger.info("{height}: wait {num_blocks} blocks until this round ends...".format(
+                    height=height,
+                    num_blocks=num_blocks_till_next_round))
+        except:
+            # a failed round must not stop this chain's thread while the other chains keep voting
+            logger.exception("Error in round %d of %s", next_height_round, chain.chain_id)
+            alerts.alert("Oracle round {} on {} failed at height {}, check the logs".format(
+                next_height_round, chain.chain_id, height), key=("round-error", chain.chain_id))
+
+
+fx_cache = FxCache(
+    {fx_key: fx_api_collection[fx_key] for fx_key in fx_api_option.split(",")},
+    parse_provider_seconds(fx_refresh_interval),
+    parse_provider_seconds(fx_max_age))
+
+# set by main() when VOTE_STATE_FILE is configured
+vote_state = None
+
+
+def main():
+    """Starts the background services and votes on every configured chain until the process is stopped."""
+    global vote_state
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+    startup_timer.lap("import")
+
+    start_metrics_server(int(metrics_port))
+    alerts.start()
+    async_runtime.start()
+    lcd_pool.start(endpoint_probe_interval)
+    rpc_pool.start(endpoint_probe_interval)
+    price_history.start()
+    fx_cache.start()
+    band_data_source.warm(band_luna_price_params)
+    start_book_streams(stream_books)
+    startup_timer.lap("services")
+
+    chains = load_chains()
+    vote_state = VoteStateStore(vote_state_file) if vote_state_file and not dry_run else None
+    if vote_state is not None:
+        vote_state.restore(chains)
+    chains = [chain.start() for chain in chains]
+    startup_timer.expect(chains)
+    startup_timer.lap("chains")
+
+    # give the first FX refresh a chance so the first round does not vote negative;
+    # the block subscriptions connect meanwhile
+    fx_cache.ready.wait(http_timeout * 2)
+    startup_timer.lap("fx")
+
+    for chain in chains[1:]:
+        threading.Thread(target=run_chain, args=(chain,), name="chain-" + chain.chain_id, daemon=True).start()
+    run_chain(chains[0])
+
+
+if __name__ == "__main__":
+    main()